@@ -0,0 +1,157 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger("bgpu.asm_cache")
+
+# Sources that determine the machine code, a change to any of them invalidates the cache
+ASSEMBLER_SOURCES = ["bgpu_asm_cache.py", "bgpu_assembler.py", "bgpu_instructions.py", "bgpu_util.py", "parser.py", "util.py"]
+
+assembler_version = None
+
+def get_assembler_version() -> str:
+    global assembler_version
+    if assembler_version is None:
+        h = hashlib.sha256()
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        for name in ASSEMBLER_SOURCES:
+            with open(os.path.join(src_dir, name), "rb") as f:
+                h.update(f.read())
+        assembler_version = h.hexdigest()[:16]
+    return assembler_version
+
+def normalize_source(lines: list[str]) -> str:
+    # Whitespace and comments do not change the machine code, see Parser.parse_lines
+    normalized = []
+    for line in lines:
+        line = ' '.join(line.split('#')[0].split())
+        if len(line) > 0:
+            normalized.append(line)
+    return '\n'.join(normalized)
+
+class AsmCache:
+    # Content addressed store of assembled programs: one JSON file per
+    # program, named by the hash of the normalized source and the assembler
+    # version. Files are written to a temporary name and renamed, so
+    # concurrent processes never see partial entries. Hits refresh the file's
+    # modification time, eviction removes the least recently used entries
+    # once the directory exceeds max_bytes.
+    def __init__(self, path: str, max_bytes=64 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, lines: list[str]) -> str:
+        h = hashlib.sha256(get_assembler_version().encode())
+        h.update(normalize_source(lines).encode())
+        return h.hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.json")
+
+    def get(self, key: str):
+        # (machine code, label map, source map) or None
+        path = self.entry_path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            entry = None
+        except (OSError, ValueError) as e:
+            # Evicted by another process or damaged, assemble again
+            logger.warning("Ignoring unreadable assembler cache entry %s: %s", path, e)
+            entry = None
+
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return bytearray.fromhex(entry['code']), entry['labels'], entry['source_map']
+
+    def put(self, key: str, code: bytes, labels: dict, source_map: list[str]):
+        data = json.dumps({'code': bytes(code).hex(), 'labels': labels, 'source_map': source_map})
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+            os.replace(tmp_path, self.entry_path(key))
+        except OSError as e:
+            logger.warning("Could not store assembler cache entry: %s", e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        with self.lock:
+            self.stores += 1
+        self.evict()
+
+    def entries(self) -> list[tuple[float, int, str]]:
+        # (modification time, size, path) of every entry, oldest first
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        return entries
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            with self.lock:
+                self.evictions += 1
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        entries = self.entries()
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'entries': len(entries),
+                'bytes': sum(size for _, size, _ in entries),
+            }
+
+default_cache = None
+
+def get_default_cache():
+    # Opt-in: BGPU_ASM_CACHE names the cache directory
+    global default_cache
+    path = os.environ.get("BGPU_ASM_CACHE")
+    if not path:
+        return None
+    if default_cache is None or default_cache.path != path:
+        default_cache = AsmCache(path)
+    return default_cache
@@ -0,0 +1,25 @@
+import os
+
+from bgpu_asm_cache import AsmCache
+from bgpu_assembler import BGPUAssembler, example_asm
+
+def test_default_cache_from_environment(tmp_path, monkeypatch):
+    monkeypatch.setenv("BGPU_ASM_CACHE", str(tmp_path))
+    code = BGPUAssembler().assemble_lines(example_asm.splitlines())
+    assert len(os.listdir(tmp_path)) == 1
+    assert BGPUAssembler().assemble_lines(example_asm.splitlines()) == code
+
+def test_cache_disabled(tmp_path, monkeypatch):
+    monkeypatch.setenv("BGPU_ASM_CACHE", str(tmp_path))
+    assembler = BGPUAssembler(cache=False)
+    assert assembler.cache is None
+    assembler.assemble_lines(example_asm.splitlines())
+    assert os.listdir(tmp_path) == []
+
+def test_explicit_cache_hit(tmp_path):
+    cache = AsmCache(str(tmp_path))
+    code = BGPUAssembler(cache=cache).assemble_lines(example_asm.splitlines())
+    assembler = BGPUAssembler(cache=cache)
+    assert assembler.assemble_lines(example_asm.splitlines()) == code
+    assert cache.stats()['hits'] == 1
+    assert len(assembler.source_map) > 0
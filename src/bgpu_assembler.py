@@ -1,8 +1,13 @@
+import logging
+
 from util import ParsedInstruction, ModifierType, Modifier, OperandType, Operand
 from parser import Parser
+from bgpu_asm_cache import get_default_cache
 from bgpu_instructions import *
 from bgpu_util import float_to_hex
 
+logger = logging.getLogger("bgpu.assembler")
+
 class ValidInstruction:
     def __init__(self, name: str, allowed_modifiers: list[list[ModifierType]], allowed_operands: list[list[OperandType]], enc_fun, transform_function=None):
         self.name = name
@@ -120,13 +125,19 @@ class AssemblerIntegerUnit(AssemblerExecutionUnit):
     def encode_special(self, inst: ParsedInstruction) -> int:
         dest = encode_dest_reg(inst.operands[0])
         assert inst.operands[1].type == OperandType.SPECIAL, "Second operand must be a special operand."
-        if inst.operands[1].special == "l":
+        special = inst.operands[1].special
+        if special[0] == "l":
             subtype = IUSubtype.TID
-        elif inst.operands[1].special == "g":
+        elif special[0] == "g":
             subtype = IUSubtype.BID
         else:
-            assert False, f"Unknown special operand: {inst.operands[1].special}"
-        return dest | encode_subtype(subtype)
+            assert False, f"Unknown special operand: {special}"
+        # %l/%g are the linear IDs, %l0-%l2/%g0-%g2 select the x/y/z index
+        dim = 0
+        if len(special) > 1:
+            assert special[1:] in ["0", "1", "2"], f"Unknown special operand: {special}"
+            dim = int(special[1:]) + 1
+        return dest | encode_subtype(subtype) | encode_small_immediate(Operand(str(dim)))
 
     def expand_mov(self, parsed_inst: ParsedInstruction) -> list[ParsedInstruction]:
         if parsed_inst.is_rr():
@@ -240,7 +251,7 @@ class AssemblerBranchUnit(AssemblerExecutionUnit):
         dest_addr = self.label_addresses.get(label_mod.value, None)
         assert dest_addr is not None, f"Label not found: {label_mod.value}"
         offset = dest_addr - (inst.addr + 1)
-        print(f"Branch from address {inst.addr} to label {label_mod.value} at address {dest_addr} with offset {offset}")
+        logger.debug("Branch from address %d to label %s at address %d with offset %d", inst.addr, label_mod.value, dest_addr, offset)
         assert -128 <= offset <= 127, "Branch offset out of range"
         offset = offset & 0xFF
 
@@ -263,6 +274,7 @@ class AssemblerBranchUnit(AssemblerExecutionUnit):
         self.eu_enc = 2
         self.instructions = [
             ValidInstruction("stop", [], [], lambda inst: encode_subtype(BRUSubtype.STOP)),
+            ValidInstruction("jmp", [], [OperandType.REGISTER], lambda inst: encode_subtype(BRUSubtype.JMP) | encode_register(inst.operands[0], 1)),
             ValidInstruction("sync", [[ModifierType.SYNC_DOMAIN]], [], lambda inst: encode_subtype(BRUSubtype.SYNC_THREADS) if inst.modifiers[0].value == 'threads' else None),
             ValidInstruction("br", [[ModifierType.CONDITION], [ModifierType.LABEL]], [OperandType.REGISTER], lambda inst: self.encode_branch(inst)),
         ]
@@ -285,40 +297,79 @@ class AssemblerFPUnit(AssemblerExecutionUnit):
         ]
 
 class BGPUAssembler():
-    def __init__(self):
+    def __init__(self, cache=None):
         self.parser = Parser()
+        # Assembled programs are looked up in cache (an AsmCache) before parsing.
+        # None uses the default cache, only enabled through BGPU_ASM_CACHE,
+        # False disables caching.
+        if cache is None:
+            cache = get_default_cache()
+        self.cache = cache if cache is not False else None
+        # Source line of every instruction address of the last program
+        self.source_map = []
         self.executions_units = [AssemblerIntegerUnit(), AssemblerLoadStoreUnit(), AssemblerBranchUnit(), AssemblerFPUnit()]
+        # Instructions by mnemonic, in execution unit order
+        self.instructions_by_name = {}
+        for eu in self.executions_units:
+            for instr in eu.get_instructions():
+                self.instructions_by_name.setdefault(instr.name, []).append((eu, instr))
+        # Signature -> first valid instruction of every execution unit
+        self.matches = {}
+
+    def lookup(self, parsed_inst: ParsedInstruction) -> list[tuple[AssemblerExecutionUnit, ValidInstruction]]:
+        # Validity only depends on the mnemonic and the modifier and operand
+        # types, each signature is validated once per assembler
+        signature = parsed_inst.signature()
+        matches = self.matches.get(signature)
+        if matches is None:
+            matches = []
+            for eu, instr in self.instructions_by_name.get(parsed_inst.instruction, []):
+                if all(match_eu is not eu for match_eu, _ in matches) and instr.is_valid(parsed_inst):
+                    matches.append((eu, instr))
+            self.matches[signature] = matches
+        return matches
 
     def expand_instruction(self, parsed_inst: ParsedInstruction) -> list[ParsedInstruction]:
-        expand = []
-        for eu in self.executions_units:
-            expand = eu.expand_instruction(parsed_inst)
-            if expand != []:
-                return expand
+        matches = self.lookup(parsed_inst)
+        if len(matches) > 0:
+            return matches[0][1].transform(parsed_inst)
 
-        print(f"Failed to expand instruction: {parsed_inst}:")
-        for op in parsed_inst.operands:
-            print(f"  Operand: {op.type}")
-        for mod in parsed_inst.modifiers:
-            print(f"  Modifier: {mod.type}")
-        assert False, f"Could not expand instruction: {parsed_inst}"
+        operands = ', '.join(str(op.type) for op in parsed_inst.operands)
+        modifiers = ', '.join(str(mod.type) for mod in parsed_inst.modifiers)
+        assert False, f"Could not expand instruction: {parsed_inst} (operands: {operands}; modifiers: {modifiers})"
 
     def assemble_file(self, filepath: str) -> bytearray:
-        return self.assemble(self.parser.parse_file(filepath))
+        with open(filepath, 'r') as file:
+            return self.assemble_lines(file.readlines())
 
     def assemble_lines(self, lines: list[str]) -> bytearray:
-        return self.assemble(self.parser.parse_lines(lines))
+        if self.cache is None:
+            return self.assemble(self.parser.parse_lines(lines))
+
+        key = self.cache.key(lines)
+        cached = self.cache.get(key)
+        if cached is not None:
+            machine_code, label_addresses, self.source_map = cached
+            self.executions_units[2].label_addresses = label_addresses
+            return machine_code
+
+        machine_code = self.assemble(self.parser.parse_lines(lines))
+        self.cache.put(key, machine_code, self.executions_units[2].label_addresses, self.source_map)
+        return machine_code
 
     def assemble(self, parsed_instructions: list[ParsedInstruction]) -> bytearray:
         # exapand instructions
+        debug = logger.isEnabledFor(logging.DEBUG)
         expanded_instructions = []
         for parsed_inst in parsed_instructions:
-            print(f"Expanding instruction: {parsed_inst}")
+            if debug:
+                logger.debug("Expanding instruction: %s", parsed_inst)
             expanded_instructions.extend(self.expand_instruction(parsed_inst))
 
-        print("Expanded instructions:")
-        for inst in expanded_instructions:
-            print(inst)
+        if debug:
+            logger.debug("Expanded instructions:\n%s", '\n'.join(str(inst) for inst in expanded_instructions))
+
+        self.source_map = [inst.source_line for inst in expanded_instructions]
 
         # Search for labels
         label_addresses = {}
@@ -327,10 +378,8 @@ class BGPUAssembler():
             if inst.label is not None:
                 label_addresses[inst.label] = addr
 
-        # Print labels
-        print("Labels found:")
-        for label, addr in label_addresses.items():
-            print(f"  {label}: {addr}")
+        if debug:
+            logger.debug("Labels found: %s", label_addresses)
 
         # Push label to BRU
         self.executions_units[2].label_addresses = label_addresses
@@ -338,22 +387,22 @@ class BGPUAssembler():
         # Encode instructions
         machine_code = bytearray()
         for inst in expanded_instructions:
-            print(f"Encoding instruction: {str(inst)}")
+            if debug:
+                logger.debug("Encoding instruction: %s", inst)
             encoded = False
-            for eu in self.executions_units:
-                enc_inst = eu.encode_instruction(inst)
+            for eu, instr in self.lookup(inst):
+                enc_inst = instr.enc_fun(inst)
                 if enc_inst is not None:
+                    enc_inst = eu.eu_enc << 30 | enc_inst
                     bytecode = enc_inst.to_bytes(4, byteorder='little')
                     machine_code.extend(bytecode)
                     encoded = True
-                    print(f"Encoded instruction to machine code: 0x{enc_inst.to_bytes(4, byteorder='big').hex()}")
+                    if debug:
+                        logger.debug("Encoded instruction to machine code: %#010x", enc_inst)
                     break
             if not encoded:
                 raise ValueError(f"Could not encode instruction: {inst}")
 
-        for i, byte in enumerate(machine_code):
-            print(f"Byte {i}: 0x{byte:02X}")
-
         # Output machine code
         return machine_code
 
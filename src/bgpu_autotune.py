@@ -0,0 +1,192 @@
+import itertools
+import json
+import logging
+import os
+import time
+
+from bgpu_kernels import BLOCK_SIZE
+
+logger = logging.getLogger("bgpu.autotune")
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "bgpu", "autotune.json")
+
+class Autotuner:
+    # Times a kernel over candidate TBlock sizes and dispatch chunk sizes and
+    # remembers the fastest configuration per (kernel, problem shape, device)
+    # in a JSON file. The problem shape is the total thread count per
+    # dimension, global_size * local_size. Kernels see their TBlock size only
+    # through their arguments, so other local sizes are only tried when the
+    # caller can rebuild the arguments (args_for), otherwise only the grid
+    # split is tuned. Candidates that fault or whose outputs differ from the
+    # requested configuration are rejected. The emulator's cycle count does
+    # not depend on the chunk size and smaller chunks only add dispatches, so
+    # with the counters metric only whole dispatches are tried; chunk sizes
+    # are tuned by wall time.
+    def __init__(self, driver, cache_path=None, metric='auto', repeats=3):
+        if cache_path is None:
+            cache_path = os.environ.get("BGPU_AUTOTUNE_CACHE", DEFAULT_CACHE_PATH)
+        if metric == 'auto':
+            # The emulator's counters are deterministic, its wall time is not representative
+            metric = 'counters' if hasattr(driver.con, 'perf_counters') else 'time'
+        assert metric in ('counters', 'time'), f"Unknown autotuning metric: {metric}"
+        self.driver = driver
+        self.cache_path = cache_path
+        self.metric = metric
+        self.repeats = repeats
+        self.entries = self.load()
+
+    def load(self) -> dict:
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f).get('entries', {})
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable autotuning cache %s: %s", self.cache_path, e)
+            return {}
+
+    def save(self):
+        # Written to a temporary file first, readers never see a partial cache.
+        # Entries other processes stored since the load are kept.
+        entries = self.load()
+        entries.update(self.entries)
+        self.entries = entries
+        directory = os.path.dirname(self.cache_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({'version': 1, 'entries': self.entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.cache_path)
+
+    def device_name(self) -> str:
+        con = self.driver.con
+        if hasattr(con, 'cu'):
+            return f"{self.driver.backend}-w{con.cu.warp_width}"
+        return self.driver.backend
+
+    def cache_key(self, program, shape) -> str:
+        return f"{self.driver.kernel_key(program).hex()}:{'x'.join(str(n) for n in shape)}:{self.device_name()}"
+
+    def lookup(self, program, global_size, local_size, automatic=False):
+        # Tuned (global_size, local_size, chunk_blocks) for this launch, None if
+        # not tuned. Automatic lookups skip kernels whose arguments depend on
+        # the configuration, their callers have to rebuild the arguments.
+        shape = [g * l for g, l in zip(global_size, local_size)]
+        entry = self.entries.get(self.cache_key(program, shape))
+        if entry is None or (automatic and not entry['automatic']):
+            return None
+        local = tuple(entry['local_size'])
+        return tuple(n // l for n, l in zip(shape, local)), local, entry['chunk_blocks']
+
+    def candidates(self, shape, local_sizes=None) -> list:
+        # Every local size that tiles the shape and fits a TBlock (or the given
+        # ones), with the full chunk size and, timed by wall clock, smaller
+        # splits of the grid
+        chunks = sorted({self.driver.max_dispatch_blocks, max(1, self.driver.max_dispatch_blocks // 2), max(1, self.driver.max_dispatch_blocks // 4)}, reverse=True)
+        if self.metric == 'counters':
+            chunks = chunks[:1]
+        if local_sizes is None:
+            local_sizes = itertools.product(*[range(1, min(n, BLOCK_SIZE) + 1) for n in shape])
+        configs = []
+        for local in local_sizes:
+            if local[0] * local[1] * local[2] > BLOCK_SIZE or any(n % l != 0 for n, l in zip(shape, local)):
+                continue
+            for chunk in chunks:
+                configs.append((tuple(n // l for n, l in zip(shape, local)), local, chunk))
+        return configs
+
+    def measure(self, program, function_name, params, written, global_size, local_size, chunk_blocks) -> float:
+        driver = self.driver
+        if self.metric == 'counters':
+            # Issue cycles first, dispatches break ties
+            driver.con.reset_perf_counters()
+            driver.launch(program, function_name, params, written, global_size, local_size, chunk_blocks=chunk_blocks)
+            counters = driver.con.perf_counters()
+            return counters['cycles'] + counters['dispatches'] * 1e-3
+        best = None
+        for _ in range(self.repeats):
+            start = time.perf_counter()
+            driver.launch(program, function_name, params, written, global_size, local_size, chunk_blocks=chunk_blocks)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def tune(self, *args, global_size:tuple[int,int,int], local_size:tuple[int,int,int], program, function_name:str, access=None, args_for=None) -> dict:
+        # args_for(global_size, local_size) returns the kernel arguments of a
+        # candidate, for kernels that take their launch geometry as scalars.
+        # Buffer contents are restored afterwards, tuning has no visible side effects.
+        from bgpu_driver import Access
+        driver = self.driver
+        arg_bufs = args[0]
+        assert len(global_size) == 3 and len(local_size) == 3, "Global and local sizes must be 3-tuples."
+        shape = [g * l for g, l in zip(global_size, local_size)]
+        program = bytes(program)
+
+        with driver.lock:
+            written = driver.written_args(arg_bufs, access)
+            # Without qualifiers every buffer argument counts as written
+            buffers = driver.written_args(arg_bufs, [None] * len(arg_bufs))
+            snapshot = []
+            for buf in buffers:
+                data = bytearray(buf[1])
+                driver.copy_d2h(memoryview(data), buf)
+                snapshot.append(data)
+
+            def restore():
+                for buf, data in zip(buffers, snapshot):
+                    if driver.mem.access_of(buf) in (Access.WRITE_ONLY, Access.SCRATCH):
+                        # copy_h2d drops uploads to these buffers
+                        driver.mem.invalidate(buf)
+                        driver.con.write_block(buf[0], bytes(data))
+                    else:
+                        driver.copy_h2d(buf, memoryview(data))
+
+            def outputs():
+                results = []
+                for buf in written:
+                    data = bytearray(buf[1])
+                    driver.copy_d2h(memoryview(data), buf)
+                    results.append(bytes(data))
+                return results
+
+            requested = (tuple(global_size), tuple(local_size), driver.max_dispatch_blocks)
+            local_sizes = None if args_for is not None else [tuple(local_size)]
+            configs = [requested] + [config for config in self.candidates(shape, local_sizes) if config != requested]
+            reference = None
+            results = []
+            try:
+                for config in configs:
+                    restore()
+                    params = driver.pack_params(arg_bufs if args_for is None else args_for(config[0], config[1]))
+                    try:
+                        score = self.measure(program, function_name, params, written, *config)
+                    except Exception as e:
+                        assert reference is not None, f"Requested configuration of {function_name} failed: {e}"
+                        logger.debug("Rejected %s for %s: %s", config, function_name, e)
+                        continue
+                    result = outputs()
+                    if reference is None:
+                        reference = result
+                    elif result != reference:
+                        logger.debug("Rejected %s for %s: outputs differ from the requested configuration.", config, function_name)
+                        continue
+                    results.append((score, config))
+                    logger.debug("Autotuning %s: local size %s, chunks of %d TBlocks: %g", function_name, config[1], config[2], score)
+            finally:
+                restore()
+
+        score, (best_global, best_local, best_chunk) = min(results, key=lambda result: result[0])
+        entry = {
+            'function': function_name,
+            'local_size': list(best_local),
+            'chunk_blocks': best_chunk,
+            'metric': self.metric,
+            'score': score,
+            'candidates': len(results),
+            'automatic': args_for is None,
+        }
+        self.entries[self.cache_key(program, shape)] = entry
+        self.save()
+        logger.info("Tuned %s for shape %s: local size %s, chunks of %d TBlocks (%s %g).", function_name, shape, best_local, best_chunk, self.metric, score)
+        return dict(entry, global_size=list(best_global))
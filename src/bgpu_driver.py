@@ -1,14 +1,147 @@
-from bgpu_emu import CU, EmuJtag
-from bgpu_jtag import GdbJtag
+from __future__ import annotations
+
+import bisect
+import logging
+import hashlib
+import importlib
+import math
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from enum import Enum
+from typing import TYPE_CHECKING
+
+# NumPy and the feature modules are imported on first use, a driver for a
+# hardware backend starts without them
+from bgpu_profiler import NULL_PROFILER
+
+if TYPE_CHECKING:
+    import numpy as np
+
+    from bgpu_autotune import Autotuner
+    from bgpu_graph import BgpuGraph
+    from bgpu_persistent import PersistentQueue
+    from bgpu_profiler import BgpuProfiler
+    from bgpu_stream import BgpuStream
+
+logger = logging.getLogger("bgpu.driver")
+mem_logger = logging.getLogger("bgpu.mem")
+
+class DispatchTimeoutError(TimeoutError):
+    pass
+
+class DispatchCancelledError(Exception):
+    pass
+
+class Access(Enum):
+    # How kernels use a buffer. Uploads to WRITE_ONLY and SCRATCH buffers are
+    # dropped, kernels never invalidate the host's copy of READ_ONLY buffers.
+    READ_ONLY = 0
+    WRITE_ONLY = 1
+    READ_WRITE = 2
+    SCRATCH = 3
+
+class Buffer(tuple):
+    # A device allocation. Unpacks and indexes like the (addr, size) tuples
+    # used throughout the driver, and optionally carries an element type and
+    # shape for NumPy interop.
+    def __new__(cls, addr: int, size: int, dtype=None, shape=None):
+        buf = super().__new__(cls, (addr, size))
+        if dtype is not None:
+            import numpy as np
+            dtype = np.dtype(dtype)
+        buf.dtype = dtype
+        buf.shape = None if shape is None else tuple(shape)
+        return buf
+
+    @property
+    def addr(self) -> int:
+        return self[0]
+
+    @property
+    def size(self) -> int:
+        return self[1]
+
+    @property
+    def nbytes(self) -> int:
+        # Bytes holding elements, the allocation may be padded to whole words
+        if self.dtype is None:
+            return self[1]
+        return math.prod(self.shape) * self.dtype.itemsize
+
+class Scalar:
+    # A kernel argument passed by value: its 32-bit pattern goes straight
+    # into the parameter block, the kernel reads it with a single ldparam.
+    # dtype is a type name, NumPy types and dtypes are accepted as well.
+    DTYPES = ('int32', 'uint32', 'float32')
+
+    def __init__(self, value, dtype='int32'):
+        self.dtype = dtype if isinstance(dtype, str) else getattr(dtype, 'name', None) or getattr(dtype, '__name__', str(dtype))
+        assert self.dtype in self.DTYPES, f"Unsupported scalar type: {self.dtype}"
+        self.value = value
+
+    def word(self) -> int:
+        if self.dtype == 'float32':
+            return struct.unpack('<I', struct.pack('<f', float(self.value)))[0]
+        return int(self.value) & 0xFFFFFFFF
+
+    def __repr__(self):
+        return f"Scalar({self.value}, {self.dtype})"
+
+def as_scalar(arg):
+    # Plain Python and NumPy numbers are scalar arguments too, everything
+    # else is a buffer. None for buffers.
+    if isinstance(arg, Scalar):
+        return arg
+    # Without NumPy loaded there are no NumPy numbers
+    np = sys.modules.get('numpy')
+    if np is not None and isinstance(arg, np.generic):
+        return Scalar(arg, arg.dtype)
+    if isinstance(arg, bool) or not isinstance(arg, (int, float)):
+        return None
+    if isinstance(arg, float):
+        return Scalar(arg, 'float32')
+    return Scalar(arg, 'uint32' if arg >= (1 << 31) else 'int32')
+
+def as_bytes(data) -> memoryview:
+    # Flat byte view of anything supporting the buffer protocol, no copy
+    view = memoryview(data)
+    if view.format != 'B' or view.ndim != 1:
+        view = view.cast('B')
+    return view
+
+def pack_words(values) -> bytes:
+    return struct.pack(f'<{len(values)}I', *values)
+
+# Connection backends by name: (module, class). A backend's module is only
+# imported when a driver uses it, so emulator runs never load pygdbmi.
+BACKENDS = {
+    'emu': ('bgpu_emu', 'EmuJtag'),
+    'gdb': ('bgpu_jtag', 'GdbJtag'),
+    'openocd': ('bgpu_openocd', 'OpenOcdJtag'),
+}
+
+def register_backend(name: str, module: str, class_name: str):
+    BACKENDS[name] = (module, class_name)
+
+def load_backend(name: str):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown BGPU connection backend: {name}")
+    module, class_name = BACKENDS[name]
+    return getattr(importlib.import_module(module), class_name)
 
 class Bgpu:
     def __init__(self, con):
         self.con = con
         self.base = 0xFFFFFF00
+        self.dispatch_time = None
+        self.launch_geometry = (0, 0)
 
     def write_thread_engine_register(self, reg, value, check=True):
         address = self.base + reg * 4
-        print(f"Writing to thread engine register: {address:#010x} = {value:#010x}")
+        logger.debug("Writing to thread engine register: %#010x = %#010x", address, value)
         self.con.write(address, value, check)
 
     def read_thread_engine_register(self, reg):
@@ -16,152 +149,950 @@ class Bgpu:
         return self.con.read(address)
 
     def dispatch_threads(self, pc, dp_addr, tblock_size, tblocks_to_dispatch, tgroup_id, inorder):
-        print(f"Dispatching threads: PC={pc:#010x}, DP_ADDR={dp_addr:#010x}, TBlockSize={tblock_size}, TBlocks={tblocks_to_dispatch}, TGroupID={tgroup_id}")
+        logger.debug("Dispatching threads: PC=%#010x, DP_ADDR=%#010x, TBlockSize=%d, TBlocks=%d, TGroupID=%d", pc, dp_addr, tblock_size, tblocks_to_dispatch, tgroup_id)
         assert pc % 4 == 0, "PC must be word-aligned."
         assert dp_addr % 4 == 0, "Data pointer address must be word-aligned."
-        self.write_thread_engine_register(0, pc // 4) # PC in words
-        self.write_thread_engine_register(1, dp_addr) # Data pointer address in bytes
-        self.write_thread_engine_register(2, tblocks_to_dispatch)
-        self.write_thread_engine_register(3, tgroup_id)
-        self.write_thread_engine_register(4, tblock_size)
+        # Queue the configuration registers and wait once
+        self.con.write_many([
+            (self.base + 0 * 4, pc // 4), # PC in words
+            (self.base + 1 * 4, dp_addr), # Data pointer address in bytes
+            (self.base + 2 * 4, tblocks_to_dispatch),
+            (self.base + 3 * 4, tgroup_id),
+            (self.base + 4 * 4, tblock_size),
+        ])
 
         # Dispatch the threads
-        print("Dispatching threads...")
         self.write_thread_engine_register(5, 1 if inorder else 0, check=False)
+        self.dispatch_time = time.monotonic()
 
-    def dispatch_status(self):
-        status = self.read_thread_engine_register(5)
-        status_bin = bin(status)[2:].zfill(32)
+    def launch_dims(self, global_size: tuple[int,int,int], local_size: tuple[int,int,int]) -> tuple[int, int]:
+        # Register values for the per-dimension %g0-%g2/%l0-%l2 specials, 0
+        # for 1D launches. Only backends with the grid and block registers
+        # (supports_launch_geometry) take multi-dimensional launches, the RTL
+        # thread engine does not have them yet.
+        gx, gy, gz = global_size
+        lx, ly, lz = local_size
+        if gy * gz == 1 and ly * lz == 1:
+            return 0, 0
+        assert getattr(self.con, 'supports_launch_geometry', False), f"Multi-dimensional launch (global size {tuple(global_size)}, local size {tuple(local_size)}) needs the grid and block registers, which this backend does not have. Linearize the launch instead."
+        assert gx < (1 << 16) and gy < (1 << 16), "Grid x/y extents must fit in 16 bits."
+        assert lx < (1 << 8) and ly < (1 << 8), "Block x/y extents must fit in 8 bits."
+        return gx | gy << 16, lx | ly << 8
+
+    def set_launch_geometry(self, global_size: tuple[int,int,int], local_size: tuple[int,int,int]):
+        # 1D launches leave both registers at 0, so they are only written
+        # when the geometry changes
+        grid_dims, block_dims = self.launch_dims(global_size, local_size)
+        if (grid_dims, block_dims) == self.launch_geometry:
+            return
+        self.con.write_many([
+            (self.base + 6 * 4, grid_dims),
+            (self.base + 7 * 4, block_dims),
+        ])
+        self.launch_geometry = (grid_dims, block_dims)
 
-        print(f"Dispatch status: {status:#010x} ({status_bin})")
+    def dispatch_chunk(self, tblocks_to_dispatch, tgroup_id, inorder):
+        # Follow-up dispatch reusing PC, data pointer and TBlock size from
+        # dispatch_threads. The block count, thread group ID and start go out
+        # as one batch, the group ID offsets the block IDs of this chunk.
+        logger.debug("Dispatching chunk: TBlocks=%d, TGroupID=%d", tblocks_to_dispatch, tgroup_id)
+        self.con.write_many([
+            (self.base + 2 * 4, tblocks_to_dispatch),
+            (self.base + 3 * 4, tgroup_id),
+            (self.base + 5 * 4, 1 if inorder else 0),
+        ], check=False)
+        self.dispatch_time = time.monotonic()
 
-        # Reverse the status bits
-        new_status_bin = ''
-        for i in range(32):
-            new_status_bin += status_bin[31 - i]
+    def dispatch_status(self):
+        status = self.read_thread_engine_register(5)
 
-        start_dispatch = new_status_bin[0] == '1'
-        running = new_status_bin[1] == '1'
-        finished = new_status_bin[2] == '1'
+        start_dispatch = (status >> 0) & 1 == 1
+        running = (status >> 1) & 1 == 1
+        finished = (status >> 2) & 1 == 1
         num_dispatched = (status >> 4) & 0xF
         num_finished = (status >> 24) & 0xF
 
-        print(f"Start: {start_dispatch}, Running: {running}, Finished: {finished}, Dispatched: {num_dispatched}, Finished: {num_finished}")
-
         return start_dispatch, running, finished, num_dispatched, num_finished
 
+    def wait_for_completion(self, timeout=None, expected_duration=None, poll_min=1e-4, poll_max=0.05, backoff=2.0, cancel: threading.Event = None, on_poll=None, until=None) -> dict:
+        # Polls the dispatch status with exponential backoff. When the expected
+        # kernel duration is known, the first poll is delayed until shortly
+        # before it, so polling does not compete with other JTAG traffic.
+        # Cancelling stops waiting, the dispatch itself keeps running. until
+        # replaces the status poll, it returns whether the wait is over and
+        # the timeout counts from the call instead of the dispatch.
+        start = self.dispatch_time if self.dispatch_time is not None and until is None else time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        interval = poll_min
+        delay = 0.0 if expected_duration is None else 0.9 * expected_duration - (time.monotonic() - start)
+        polls = 0
+        last_poll = start
+        while True:
+            if delay > 0:
+                if deadline is not None:
+                    delay = min(delay, max(0.0, deadline - time.monotonic()))
+                if cancel is not None:
+                    if cancel.wait(delay):
+                        raise DispatchCancelledError(f"Waiting for dispatch cancelled after {polls} polls")
+                else:
+                    time.sleep(delay)
+
+            if until is None:
+                status = self.dispatch_status()
+                finished = status[2]
+                if on_poll is not None:
+                    on_poll(status)
+            else:
+                finished = until()
+            now = time.monotonic()
+            polls += 1
+            if finished:
+                break
+            last_poll = now
+
+            if deadline is not None and now >= deadline:
+                raise DispatchTimeoutError(f"Dispatch did not finish within {timeout} s ({polls} polls)")
+            delay = interval
+            interval = min(interval * backoff, poll_max)
+
+        self.dispatch_time = None
+        return {
+            'latency': now - start,
+            'polls': polls,
+            # Upper bound on how long the finished kernel went unnoticed
+            'time_to_detect': now - last_poll,
+        }
+
 class BgpuMemManager:
-    def __init__(self, con):
+    def __init__(self, con, memory_size=1 << 16, alignment=4, merge_gap=16, compression='auto', min_repeat=8, max_record_words=256, gather_gap=256):
+        assert alignment % 4 == 0 and (alignment & (alignment - 1)) == 0, "Alignment must be a power of two multiple of 4 bytes."
         self.con = con
-        self.allocations = []
+        self.memory_size = memory_size
+        self.alignment = alignment
+        # Free ranges as (addr, size), sorted by address and never adjacent
+        self.free_list = [(0, memory_size)]
+        # Live allocations: addr -> size, and their addresses in order
+        self.allocations = {}
+        self.bases = []
+        self.used = 0
+        self.high_water = 0
         self.top_of_mem = 0
+        # Host-side copy of what we believe is on the device: allocation addr -> known prefix
+        self.shadows = {}
+        self.merge_gap = merge_gap
+        self.profiler = NULL_PROFILER
+        # Access qualifier per allocation addr
+        self.access = {}
+        self.skipped_upload_bytes = 0
+        self.skipped_readback_bytes = 0
+        # Compressed uploads: 'auto', 'always' or 'never'. Runs of at least
+        # min_repeat equal words are expanded on the device by expander,
+        # set by the driver, instead of crossing the link. engine_idle tells
+        # whether the thread engine can take the expand dispatch right now.
+        assert compression in ('auto', 'always', 'never'), f"Unknown compression mode: {compression}"
+        self.compression = compression
+        self.min_repeat = min_repeat
+        self.max_record_words = max_record_words
+        self.expander = None
+        self.engine_idle = None
+        self.expanding = False
+        # Measured raw upload rate in bytes/s and time of one expansion, for the auto mode
+        self.upload_rate = None
+        self.expand_time = None
+        self.smoothing = 0.25
+        self.compressed_uploads = 0
+        self.compressed_bytes_saved = 0
+        # Vectored transfers read up to gather_gap unrequested bytes to join two ranges
+        self.gather_gap = gather_gap
 
-    def alloc(self, size: int):
-        print(f"Allocating {size} bytes of BGPU memory.")
+    def alloc(self, size: int, alignment=None, access=Access.READ_WRITE):
+        assert size > 0, "Allocation size must be positive."
         assert size % 4 == 0, "Allocation size must be a multiple of 4 bytes."
-        # Find next available address -> outside memory
-        addr = self.top_of_mem
-        # Expand memory
-        self.top_of_mem += size
-        # Record allocation
-        buf = (addr, size)
-        self.allocations.append(buf)
-        print(f"Allocated buffer at address {addr:#010x} of size {size} bytes.")
+        alignment = self.alignment if alignment is None else alignment
+        assert alignment % 4 == 0 and (alignment & (alignment - 1)) == 0, "Alignment must be a power of two multiple of 4 bytes."
+
+        # Best fit: smallest free range that holds the aligned allocation
+        best = None
+        for idx, (start, length) in enumerate(self.free_list):
+            addr = (start + alignment - 1) & ~(alignment - 1)
+            if addr - start + size > length:
+                continue
+            if best is None or length < self.free_list[best][1]:
+                best = idx
+        if best is None:
+            raise MemoryError(f"Out of BGPU memory: cannot allocate {size} bytes with alignment {alignment} ({self.used} of {self.memory_size} bytes in use, largest free block {self.largest_free()} bytes)")
+
+        # Split the free range, returning the alignment padding and the tail
+        start, length = self.free_list.pop(best)
+        addr = (start + alignment - 1) & ~(alignment - 1)
+        remainder = []
+        if addr > start:
+            remainder.append((start, addr - start))
+        if addr + size < start + length:
+            remainder.append((addr + size, start + length - addr - size))
+        self.free_list[best:best] = remainder
+
+        # Record allocation
+        self.allocations[addr] = size
+        bisect.insort(self.bases, addr)
+        self.access[addr] = access
+        self.used += size
+        self.high_water = max(self.high_water, self.used)
+        self.top_of_mem = max(self.top_of_mem, addr + size)
+        buf = Buffer(addr, size)
+        mem_logger.debug("Allocated buffer at address %#010x of size %d bytes.", addr, size)
         return buf
 
-    def copy_h2d(self, dest, src:memoryview):
+    def free(self, buf):
+        addr, size = buf
+        assert self.allocations.get(addr) == size, f"Freeing unknown buffer at address {addr:#010x} of size {size} bytes."
+        del self.allocations[addr]
+        del self.bases[bisect.bisect_left(self.bases, addr)]
+        del self.access[addr]
+        self.shadows.pop(addr, None)
+        self.used -= size
+
+        # Insert and coalesce with the neighbouring free ranges
+        idx = bisect.bisect_left(self.free_list, (addr, size))
+        start, end = addr, addr + size
+        if idx < len(self.free_list) and self.free_list[idx][0] == end:
+            end += self.free_list.pop(idx)[1]
+        if idx > 0 and sum(self.free_list[idx - 1]) == start:
+            idx -= 1
+            start = self.free_list.pop(idx)[0]
+        self.free_list.insert(idx, (start, end - start))
+
+    def largest_free(self) -> int:
+        return max((length for _, length in self.free_list), default=0)
+
+    def stats(self) -> dict:
+        free = self.memory_size - self.used
+        largest = self.largest_free()
+        return {
+            'memory_size': self.memory_size,
+            'used': self.used,
+            'free': free,
+            'allocations': len(self.allocations),
+            'free_blocks': len(self.free_list),
+            'largest_free': largest,
+            # 0.0 when all free memory is one block, towards 1.0 when it is scattered
+            'fragmentation': 1.0 - largest / free if free > 0 else 0.0,
+            'high_water': self.high_water,
+            'top_of_mem': self.top_of_mem,
+            'skipped_upload_bytes': self.skipped_upload_bytes,
+            'skipped_readback_bytes': self.skipped_readback_bytes,
+            'compressed_uploads': self.compressed_uploads,
+            'compressed_bytes_saved': self.compressed_bytes_saved,
+        }
+
+    def access_of(self, buf) -> Access:
+        base = self.find_allocation(buf[0])
+        return Access.READ_WRITE if base is None else self.access[base]
+
+    def find_allocation(self, addr: int):
+        idx = bisect.bisect_right(self.bases, addr) - 1
+        if idx >= 0 and addr < self.bases[idx] + self.allocations[self.bases[idx]]:
+            return self.bases[idx]
+        return None
+
+    def invalidate(self, buf):
+        # The device may have written this buffer, forget what we think is on
+        # it. The shadow is a known prefix of the allocation, a buffer inside
+        # the allocation cuts it short at the buffer's start.
+        base = self.find_allocation(buf[0])
+        shadow = self.shadows.get(base) if base is not None else None
+        if shadow is None:
+            return
+        offset = buf[0] - base
+        if offset == 0:
+            del self.shadows[base]
+        else:
+            del shadow[offset:]
+
+    def shadow_bytes(self, addr: int, size: int):
+        # The host's copy of [addr, addr + size) if all of it is known
+        base = self.find_allocation(addr)
+        shadow = self.shadows.get(base) if base is not None else None
+        if shadow is None or addr - base + size > len(shadow):
+            return None
+        return bytes(shadow[addr - base:addr - base + size])
+
+    def update_shadow(self, addr: int, data: bytes):
+        base = self.find_allocation(addr)
+        if base is None:
+            return
+        offset = addr - base
+        shadow = self.shadows.get(base)
+        if shadow is None:
+            if offset == 0:
+                self.shadows[base] = bytearray(data)
+        elif offset <= len(shadow):
+            shadow[offset:offset + len(data)] = data
+
+    def changed_runs(self, old: bytes, new: bytes) -> list[list[int]]:
+        # Byte ranges [start, end) of changed words, runs closer than merge_gap are merged
+        runs = []
+        known = min(len(old), len(new))
+        block = 64
+        for block_start in range(0, known, block):
+            block_end = min(block_start + block, known)
+            if old[block_start:block_end] == new[block_start:block_end]:
+                continue
+            for w in range(block_start, block_end, 4):
+                if old[w:w+4] == new[w:w+4]:
+                    continue
+                if len(runs) > 0 and w - runs[-1][1] <= self.merge_gap:
+                    runs[-1][1] = w + 4
+                else:
+                    runs.append([w, w + 4])
+        # Everything past the known part of the shadow has to be sent
+        if known < len(new):
+            if len(runs) > 0 and known - runs[-1][1] <= self.merge_gap:
+                runs[-1][1] = len(new)
+            else:
+                runs.append([known, len(new)])
+        return runs
+
+    def copy_h2d(self, dest, src:memoryview, compress=True):
         addr, dest_size = dest
-        print(f"Copying {len(src)} bytes from host to device at address {addr:#010x}.")
+        src = as_bytes(src)
         src_size = len(src)
         assert src_size <= dest_size, "Source data is larger than allocated buffer."
         assert src_size % 4 == 0, "Source data size must be a multiple of 4 bytes."
-        for i in range(src_size // 4):
-            data = int.from_bytes(src[i*4:i*4+4], byteorder='little')
-            print(f"Writing data to device memory at address {addr + i * 4:#010x}: {data:#010x}")
-            self.con.write(addr + i * 4, data)
+        # The kernels overwrite these before reading them
+        if self.access_of(dest) in (Access.WRITE_ONLY, Access.SCRATCH):
+            self.skipped_upload_bytes += src_size
+            mem_logger.debug("Skipped upload of %d bytes to write-only buffer at address %#010x.", src_size, addr)
+            return
+        data = bytes(src)
+
+        # Only send the words that differ from what the device already holds
+        base = self.find_allocation(addr)
+        shadow = self.shadows.get(base) if base is not None else None
+        if shadow is not None and addr - base <= len(shadow):
+            offset = addr - base
+            runs = self.changed_runs(shadow[offset:offset + src_size], data)
+        else:
+            runs = [[0, src_size]]
+
+        segments = None
+        if compress and self.expander is not None and self.compression != 'never' and not self.expanding:
+            segments = self.split_repeats(data, runs)
+            if not self.compression_pays(segments):
+                segments = None
+            elif not self.engine_idle():
+                mem_logger.debug("Thread engine busy, uploading %d bytes to address %#010x uncompressed.", src_size, addr)
+                segments = None
+
+        with self.profiler.span("upload", "mem", addr=addr, size=src_size, runs=len(runs), compressed=segments is not None):
+            if segments is None:
+                self.upload_raw(addr, data, runs)
+            else:
+                self.upload_compressed(addr, data, segments)
+        self.update_shadow(addr, data)
+
+        if mem_logger.isEnabledFor(logging.DEBUG):
+            mem_logger.debug("Copied %d of %d bytes in %d runs to device memory at address %#010x.", sum(end - start for start, end in runs), src_size, len(runs), addr)
+
+    def split_repeats(self, data: bytes, runs: list[list[int]]) -> list[tuple[int, int, int]]:
+        # Splits the runs into (start, end, value) segments, value is the
+        # repeated word of a long enough run and None for literal data
+        segments = []
+        for run_start, run_end in runs:
+            literal_start = run_start
+            i = run_start
+            while i < run_end:
+                word = data[i:i+4]
+                j = i + 4
+                while j < run_end and data[j:j+4] == word:
+                    j += 4
+                if (j - i) // 4 >= self.min_repeat:
+                    if literal_start < i:
+                        segments.append((literal_start, i, None))
+                    segments.append((i, j, int.from_bytes(word, byteorder='little')))
+                    literal_start = j
+                i = j
+            if literal_start < run_end:
+                segments.append((literal_start, run_end, None))
+        return segments
+
+    def compression_pays(self, segments) -> bool:
+        repeated = sum(end - start for start, end, value in segments if value is not None)
+        if repeated == 0:
+            return False
+        if self.compression == 'always':
+            return True
+        # Measure the raw rate first, then try one expansion to measure it too
+        if self.upload_rate is None:
+            return False
+        literal = sum(end - start for start, end, value in segments if value is None)
+        # Every record is three words on the link, see upload_compressed
+        records = sum(-(-(end - start) // (self.max_record_words * 4)) for start, end, value in segments if value is not None)
+        raw_time = (literal + repeated) / self.upload_rate
+        compressed_time = (literal + records * 12) / self.upload_rate + (self.expand_time or 0.0)
+        return compressed_time < raw_time
+
+    def upload_raw(self, addr: int, data: bytes, runs: list[list[int]]):
+        start_time = time.perf_counter()
+        for start, end in runs:
+            self.con.write_block(addr + start, data[start:end])
+        elapsed = time.perf_counter() - start_time
+        sent = sum(end - start for start, end in runs)
+        if elapsed > 0 and sent > 0:
+            rate = sent / elapsed
+            self.upload_rate = rate if self.upload_rate is None else self.upload_rate + self.smoothing * (rate - self.upload_rate)
+
+    def upload_compressed(self, addr: int, data: bytes, segments):
+        # Literal data goes over the link as is, repeated words as
+        # (address, count, value) records expanded by the device
+        records = []
+        for start, end, value in segments:
+            if value is None:
+                self.con.write_block(addr + start, data[start:end])
+                continue
+            # Bounded records spread long runs over several threads
+            for offset in range(start, end, self.max_record_words * 4):
+                records.append((addr + offset, min(self.max_record_words, (end - offset) // 4), value))
+
+        start_time = time.perf_counter()
+        self.expanding = True
+        try:
+            self.expander(records)
+        finally:
+            self.expanding = False
+        elapsed = time.perf_counter() - start_time
+        self.expand_time = elapsed if self.expand_time is None else self.expand_time + self.smoothing * (elapsed - self.expand_time)
 
-        print(f"Copied data to device memory at address {addr:#010x}.")
+        self.compressed_uploads += 1
+        self.compressed_bytes_saved += sum(count * 4 for _, count, _ in records) - len(records) * 12
+        mem_logger.debug("Expanded %d runs of repeated words at address %#010x on the device in %.3f ms.", len(records), addr, elapsed * 1e3)
 
     def copy_d2h(self, dest:memoryview, src):
         addr, src_size = src
-        print(f"Copying {len(dest)} bytes from device at address {addr:#010x} to host.")
+        dest = as_bytes(dest)
         dest_len = len(dest)
         assert dest_len <= src_size, "Destination buffer is smaller than source data."
         assert dest_len % 4 == 0, "Destination data size must be a multiple of 4 bytes."
-        for i in range(dest_len // 4):
-            data = self.con.read(addr + i * 4)
-            for j in range(4):
-                dest[i*4 + j] = (data >> (j * 8)) & 0xFF
+        # Nothing wrote the buffer since the host last saw its contents
+        known = self.shadow_bytes(addr, dest_len)
+        if known is not None:
+            dest[:dest_len] = known
+            self.skipped_readback_bytes += dest_len
+            mem_logger.debug("Served %d bytes at address %#010x from the host copy.", dest_len, addr)
+            return
+        with self.profiler.span("readback", "mem", addr=addr, size=dest_len):
+            data = self.con.read_block(addr, dest_len)
+        dest[:dest_len] = data
+        self.update_shadow(addr, data)
 
-        print(f"Copied data from device memory at address {addr:#010x} to host.")
+        mem_logger.debug("Copied %d bytes from device memory at address %#010x to host.", dest_len, addr)
+
+    def merge_ranges(self, ranges: list, gap: int, can_bridge) -> list[list]:
+        # Groups (addr, size, view) ranges sorted by address into
+        # [start, end, ranges] spans, can_bridge(start, end) decides whether
+        # the bytes between two ranges may be transferred too
+        spans = []
+        for addr, size, view in sorted(ranges, key=lambda r: r[0]):
+            if len(spans) > 0:
+                span = spans[-1]
+                if addr <= span[1] or (addr - span[1] <= gap and can_bridge(span[1], addr)):
+                    span[1] = max(span[1], addr + size)
+                    span[2].append((addr, size, view))
+                    continue
+            spans.append([addr, addr + size, [(addr, size, view)]])
+        return spans
+
+    def gather(self, pairs: list, gap=None):
+        # Reads many (device range, host view) pairs with as few block reads
+        # as possible. Ranges closer than gap bytes share one read, the bytes
+        # in between are read and dropped.
+        gap = self.gather_gap if gap is None else gap
+        pending = []
+        for src, dest in pairs:
+            addr, size = src
+            dest = as_bytes(dest)
+            assert len(dest) <= size, "Destination buffer is smaller than source data."
+            assert len(dest) % 4 == 0, "Destination data size must be a multiple of 4 bytes."
+            known = self.shadow_bytes(addr, len(dest))
+            if known is not None:
+                dest[:] = known
+                self.skipped_readback_bytes += len(dest)
+            elif len(dest) > 0:
+                pending.append((addr, len(dest), dest))
+
+        spans = self.merge_ranges(pending, gap, lambda start, end: True)
+        with self.profiler.span("gather", "mem", ranges=len(pairs), reads=len(spans)):
+            for start, end, ranges in spans:
+                data = self.con.read_block(start, end - start)
+                for addr, size, dest in ranges:
+                    dest[:] = data[addr - start:addr - start + size]
+                    self.update_shadow(addr, dest)
+        mem_logger.debug("Gathered %d ranges in %d block reads.", len(pairs), len(spans))
+
+    def scatter(self, pairs: list, gap=None):
+        # Writes many (device range, host view) pairs with as few block writes
+        # as possible. Ranges are only joined across bytes whose device
+        # contents the host knows, so the bridging write leaves them as they are.
+        gap = self.gather_gap if gap is None else gap
+        pending = []
+        for dest, src in pairs:
+            addr, size = dest
+            data = bytes(as_bytes(src))
+            assert len(data) <= size, "Source data is larger than allocated buffer."
+            assert len(data) % 4 == 0, "Source data size must be a multiple of 4 bytes."
+            if self.access_of(dest) in (Access.WRITE_ONLY, Access.SCRATCH):
+                self.skipped_upload_bytes += len(data)
+                continue
+            # Already on the device
+            if self.shadow_bytes(addr, len(data)) == data:
+                continue
+            if len(data) > 0:
+                pending.append((addr, len(data), data))
+
+        spans = self.merge_ranges(pending, gap, lambda start, end: self.shadow_bytes(start, end - start) is not None)
+        with self.profiler.span("scatter", "mem", ranges=len(pairs), writes=len(spans)):
+            for start, end, ranges in spans:
+                block = bytearray(end - start)
+                prev_end = start
+                for addr, size, data in ranges:
+                    assert addr >= prev_end, f"Overlapping writes at address {addr:#010x}."
+                    if addr > prev_end:
+                        block[prev_end - start:addr - start] = self.shadow_bytes(prev_end, addr - prev_end)
+                    block[addr - start:addr - start + size] = data
+                    prev_end = addr + size
+                self.con.write_block(start, bytes(block))
+                for addr, size, data in ranges:
+                    self.update_shadow(addr, data)
+        mem_logger.debug("Scattered %d ranges in %d block writes.", len(pairs), len(spans))
+
+class KernelStats:
+    def __init__(self, function_name: str, smoothing=0.25):
+        self.function_name = function_name
+        self.smoothing = smoothing
+        self.launches = 0
+        self.total_latency = 0.0
+        self.total_polls = 0
+        self.total_time_to_detect = 0.0
+        self.latency_ema = None
+
+    def record(self, metrics: dict):
+        self.launches += 1
+        self.total_latency += metrics['latency']
+        self.total_polls += metrics['polls']
+        self.total_time_to_detect += metrics['time_to_detect']
+
+    def record_chunk(self, metrics: dict, tblocks: int):
+        # Best estimate of the run time per block: detected latency minus detection delay
+        block_time = (metrics['latency'] - metrics['time_to_detect']) / tblocks
+        if self.latency_ema is None:
+            self.latency_ema = block_time
+        else:
+            self.latency_ema += self.smoothing * (block_time - self.latency_ema)
+
+    def expected_duration(self, tblocks: int):
+        return None if self.latency_ema is None else self.latency_ema * tblocks
+
+    def summary(self) -> dict:
+        launches = max(self.launches, 1)
+        return {
+            'function_name': self.function_name,
+            'launches': self.launches,
+            'mean_latency': self.total_latency / launches,
+            'mean_polls': self.total_polls / launches,
+            'mean_time_to_detect': self.total_time_to_detect / launches,
+            'expected_block_time': self.latency_ema,
+        }
+
+class CachedKernel:
+    def __init__(self, mem, kernel_len: int, params: bytes):
+        self.mem = mem
+        self.address = mem[0]
+        self.kernel_len = kernel_len
+        self.params = params
 
 class BGPUDriver:
-    def __init__(self, emu=False):
-        if emu:
-            self.con = EmuJtag()
+    def __init__(self, emu=False, backend=None, memory_size=1 << 16, alignment=4, kernel_cache_size=64, max_dispatch_blocks=15, compression='auto', **backend_args):
+        if backend is None:
+            backend = 'emu' if emu else 'gdb'
+        con_class = load_backend(backend)
+        if backend == 'emu':
+            self.con = con_class(memory_size=memory_size, **backend_args)
         else:
-            self.con = GdbJtag()
+            self.con = con_class(**backend_args)
+        self.backend = backend
         self.bgpu = Bgpu(self.con)
-        self.mem = BgpuMemManager(self.con)
-        print("BGPU Driver initialized.")
-
-    def run_kernel(self, *args, global_size:tuple[int,int,int], local_size:tuple[int,int,int], program, function_name:str):
-        print(f"BGPUDriver running kernel: {function_name}")
-        print(program)
-        print(f"Global size: {global_size}, Local size: {local_size}")
-        print(f"Kernel arguments: {args}")
-
-        # Allocate memory for the kernel
-        arg_bufs = args[0]
-        kernel_len = len(program)
-        allocate_len = kernel_len + len(arg_bufs) * 4 # assuming 4 bytes per argument -> pointer size
-        kernel_mem = self.mem.alloc(allocate_len)
-        kernel_address = kernel_mem[0]
-
-        kernel_bytes = bytearray(allocate_len)
-        
-        # Copy program
-        for i, instr in enumerate(program):
-            kernel_bytes[i] = instr
-            print(f"Kernel Byte {i}: {instr:#04x}")
-
-        # Copy arguments
-        parameter_address = kernel_len
-        for i, arg in enumerate(arg_bufs):
-            print(f"Argument {i}: {arg}")
-            buf_addr, buf_size = arg
-            buf_bytes = buf_addr.to_bytes(4, byteorder='little')
-            for j in range(4):
-                print(f"Arg {i} Byte {j}: {buf_bytes[j]:#04x}")
-                kernel_bytes[parameter_address + i*4 + j] = buf_bytes[j]
-
-        # Adjust parameter address to be absolute
-        parameter_address += kernel_address
-
-        # Copy kernel to device memory
-        self.mem.copy_h2d(kernel_mem, kernel_bytes)
-
-        # Execute kernel
-        tblock_size = local_size[0]
-        num_blocks = global_size[0]
-        self.bgpu.dispatch_status()
-        print(f"Executing kernel with tblock size: {tblock_size}")
-
-        self.bgpu.dispatch_threads(kernel_address, parameter_address, tblock_size, num_blocks, 0, inorder=True)
-
-        print("Waiting for completion...")
+        self.mem = BgpuMemManager(self.con, memory_size, alignment, compression=compression)
+        self.mem.expander = self.expand_records
+        self.mem.engine_idle = self.thread_engine_idle
+        self.kernel_cache = OrderedDict()
+        self.kernel_cache_size = kernel_cache_size
+        # Completion metrics per kernel, keyed like the kernel cache
+        self.kernel_stats = {}
+        # Digests of recently launched programs, bounded like the kernel cache
+        self.kernel_keys = OrderedDict()
+        # The dispatch status counters are 4 bits wide, larger grids are chunked
+        self.max_dispatch_blocks = max_dispatch_blocks
+        self.last_launch = None
+        self.profiler = NULL_PROFILER
+        # Consulted by run_kernel once enabled, see enable_autotuning
+        self.autotuner = None
+        # The running PersistentQueue, it occupies the thread engine
+        self.persistent_queue = None
+        # Serializes device access between the caller and stream workers
+        self.lock = threading.RLock()
+        logger.info("BGPU driver initialized with %s backend.", backend)
+
+    def run_kernel(self, *args, global_size:tuple[int,int,int], local_size:tuple[int,int,int], program, function_name:str, timeout=None, cancel: threading.Event = None, progress=None, block_range: tuple[int,int] = None, access: list[Access] = None):
+        with self.lock:
+            logger.debug("Running kernel %s: global size %s, local size %s, %d bytes of code", function_name, global_size, local_size, len(program))
+
+            arg_bufs = args[0]
+            written = self.written_args(arg_bufs, access)
+            chunk_blocks = None
+            # A tuned configuration replaces the requested one, block ranges refer to the requested grid
+            if self.autotuner is not None and block_range is None:
+                tuned = self.autotuner.lookup(program, global_size, local_size, automatic=True)
+                if tuned is not None:
+                    global_size, local_size, chunk_blocks = tuned
+            with self.profiler.span("run_kernel", "kernel", function=function_name):
+                with self.profiler.span("pack_params", "kernel"):
+                    params = self.pack_params(arg_bufs)
+                self.launch(program, function_name, params, written, global_size, local_size, timeout, cancel, progress, block_range, chunk_blocks)
+
+    def launch(self, program, function_name: str, params: bytes, written: list, global_size:tuple[int,int,int], local_size:tuple[int,int,int], timeout=None, cancel: threading.Event = None, progress=None, block_range: tuple[int,int] = None, chunk_blocks: int = None):
+        with self.lock:
+            self.check_engine_free(function_name)
+            assert len(global_size) == 3 and len(local_size) == 3, "Global and local sizes must be 3-tuples."
+            self.bgpu.launch_dims(global_size, local_size)
+            with self.profiler.span("load_kernel", "kernel", function=function_name):
+                kernel_address, parameter_address = self.load_kernel(program, params)
+
+            for buf in written:
+                self.mem.invalidate(buf)
+
+            # Execute kernel, the grid and the blocks are linearized with x varying fastest
+            tblock_size = local_size[0] * local_size[1] * local_size[2]
+            num_blocks = global_size[0] * global_size[1] * global_size[2]
+            self.bgpu.set_launch_geometry(global_size, local_size)
+            # block_range restricts the launch to a slice of the grid, e.g. one device's share
+            first_block, end_block = (0, num_blocks) if block_range is None else block_range
+            assert 0 <= first_block < end_block <= num_blocks, f"Invalid block range {block_range} for {num_blocks} TBlocks."
+            stats = self.stats_for(program, function_name)
+            metrics = self.dispatch_chunked(kernel_address, parameter_address, tblock_size, first_block, end_block, stats, timeout, cancel, progress, chunk_blocks)
+            stats.record(metrics)
+            self.last_launch = metrics
+
+            logger.debug("Kernel %s completed in %.3f ms after %d polls in %d chunks.", function_name, metrics['latency'] * 1e3, metrics['polls'], metrics['chunks'])
+
+    def written_args(self, arg_bufs, access: list[Access] = None) -> list:
+        # The kernel may write any buffer not qualified as read-only, access
+        # overrides the qualifiers given at allocation for this launch.
+        # Scalar arguments are passed by value and ignore their qualifier.
+        if access is None:
+            access = [None if as_scalar(arg) is not None else self.mem.access_of(arg) for arg in arg_bufs]
+        assert len(access) == len(arg_bufs), "Need one access qualifier per argument."
+        return [arg for arg, qualifier in zip(arg_bufs, access) if as_scalar(arg) is None and qualifier != Access.READ_ONLY]
+
+    def pack_params(self, arg_bufs) -> bytes:
+        # One word per argument: buffer pointers and scalar values
+        words = []
+        for arg in arg_bufs:
+            scalar = as_scalar(arg)
+            words.append(arg[0] if scalar is None else scalar.word())
+        return pack_words(words)
+
+    def kernel_key(self, program) -> bytes:
+        # Digests of immutable programs are remembered, relaunches skip the hashing
+        if isinstance(program, bytes):
+            key = self.kernel_keys.get(program)
+            if key is None:
+                key = hashlib.sha256(program).digest()
+                self.kernel_keys[program] = key
+                while len(self.kernel_keys) > self.kernel_cache_size:
+                    self.kernel_keys.popitem(last=False)
+            else:
+                self.kernel_keys.move_to_end(program)
+            return key
+        return hashlib.sha256(bytes(program)).digest()
+
+    def stats_for(self, program, function_name: str) -> KernelStats:
+        key = self.kernel_key(program)
+        stats = self.kernel_stats.get(key)
+        if stats is None:
+            stats = self.kernel_stats[key] = KernelStats(function_name)
+        return stats
+
+    def dispatch_chunked(self, pc, dp_addr, tblock_size, start_block, end_block, stats: KernelStats, timeout=None, cancel: threading.Event = None, progress=None, chunk_blocks: int = None) -> dict:
+        # Grids larger than one dispatch are split into chunks, each chunk's
+        # thread group ID carries the ID of its first block. Chunks run one
+        # after the other: the thread engine holds a single dispatch, reads
+        # its block count and group ID registers while it runs and rejects a
+        # start until the previous dispatch finished, so the next chunk can
+        # only be written once the poll saw the current one finish.
+        num_blocks = end_block - start_block
+        assert num_blocks > 0, "Kernel launch needs at least one TBlock."
+        chunk_blocks = self.max_dispatch_blocks if chunk_blocks is None else chunk_blocks
+        assert 0 < chunk_blocks <= self.max_dispatch_blocks, f"Chunks of {chunk_blocks} TBlocks exceed the dispatch limit of {self.max_dispatch_blocks}."
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        metrics = {'latency': 0.0, 'polls': 0, 'time_to_detect': 0.0, 'chunks': 0, 'tblocks': num_blocks}
+
+        for first_block in range(start_block, end_block, chunk_blocks):
+            tblocks = min(chunk_blocks, end_block - first_block)
+            with self.profiler.span("dispatch", "dispatch", tblocks=tblocks, tgroup_id=first_block):
+                if first_block == start_block:
+                    self.bgpu.dispatch_threads(pc, dp_addr, tblock_size, tblocks, first_block, inorder=True)
+                else:
+                    self.bgpu.dispatch_chunk(tblocks, first_block, inorder=True)
+
+            on_poll = None
+            if progress is not None:
+                on_poll = lambda status, done=first_block - start_block, tblocks=tblocks: progress(done + (tblocks if status[2] else min(status[4], tblocks)), num_blocks)
+            chunk_timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            with self.profiler.span("wait", "dispatch", tblocks=tblocks):
+                chunk = self.bgpu.wait_for_completion(timeout=chunk_timeout, expected_duration=stats.expected_duration(tblocks), cancel=cancel, on_poll=on_poll)
+            stats.record_chunk(chunk, tblocks)
+
+            metrics['polls'] += chunk['polls']
+            metrics['time_to_detect'] += chunk['time_to_detect']
+            metrics['chunks'] += 1
+
+        metrics['latency'] = time.monotonic() - start
+        return metrics
+
+    def load_kernel(self, program, params: bytes) -> tuple[int, int]:
+        # Kernel images stay resident on the device, keyed by the program bytes
+        assert len(program) % 4 == 0, "Kernel program size must be a multiple of 4 bytes."
+        key = self.kernel_key(program)
+        kernel = self.kernel_cache.get(key)
+        if kernel is not None and len(kernel.params) != len(params):
+            self.evict_kernel(key)
+            kernel = None
+
+        if kernel is None:
+            logger.debug("Uploading kernel image of %d bytes.", len(program))
+            image = bytes(program) + params
+            kernel_mem = self.alloc_evicting(len(image), Access.READ_ONLY)
+            # Uncompressed, the expand launch may evict resident kernels
+            self.mem.copy_h2d(kernel_mem, memoryview(image), compress=False)
+            kernel = CachedKernel(kernel_mem, len(program), params)
+            self.kernel_cache[key] = kernel
+            while len(self.kernel_cache) > self.kernel_cache_size:
+                self.evict_kernel(next(iter(self.kernel_cache)))
+        else:
+            self.kernel_cache.move_to_end(key)
+            # Only rewrite the parameter block when the arguments changed
+            if kernel.params != params:
+                logger.debug("Updating kernel parameter block.")
+                self.mem.copy_h2d((kernel.address + kernel.kernel_len, len(params)), memoryview(params), compress=False)
+                kernel.params = params
+
+        return kernel.address, kernel.address + kernel.kernel_len
+
+    def evict_kernel(self, key):
+        kernel = self.kernel_cache.pop(key)
+        logger.debug("Evicting kernel image at address %#010x.", kernel.address)
+        self.mem.free(kernel.mem)
+
+    def clear_kernel_cache(self):
+        with self.lock:
+            while len(self.kernel_cache) > 0:
+                self.evict_kernel(next(iter(self.kernel_cache)))
+
+    def alloc_evicting(self, size: int, access=Access.READ_WRITE):
+        # Resident kernels give way, least recently used first, when memory runs out
         while True:
-            start_dispatch, running, finished, num_dispatched, num_finished = self.bgpu.dispatch_status()
-            if finished:
-                break
+            try:
+                return self.mem.alloc(size, access=access)
+            except MemoryError:
+                if len(self.kernel_cache) == 0:
+                    raise
+                self.evict_kernel(next(iter(self.kernel_cache)))
+
+    def alloc(self, size: int, access=Access.READ_WRITE):
+        with self.lock, self.profiler.span("alloc", "mem", size=size):
+            return self.alloc_evicting(size, access)
 
-        print("Kernel execution completed.")
+    def empty(self, shape, dtype, access=Access.READ_WRITE) -> Buffer:
+        import numpy as np
+        shape = (shape,) if isinstance(shape, int) else tuple(shape)
+        nbytes = math.prod(shape) * np.dtype(dtype).itemsize
+        # Allocations are whole words
+        buf = self.alloc(max(4, (nbytes + 3) & ~3), access)
+        return Buffer(buf.addr, buf.size, dtype, shape)
+
+    def from_numpy(self, array: np.ndarray, access=Access.READ_WRITE) -> Buffer:
+        import numpy as np
+        array = np.ascontiguousarray(array)
+        buf = self.empty(array.shape, array.dtype, access)
+        self.upload(buf, array)
+        return buf
 
-    def alloc(self, size: int):
-        return self.mem.alloc(size)
+    def upload(self, buf: Buffer, array: np.ndarray):
+        import numpy as np
+        array = np.ascontiguousarray(array)
+        if array.nbytes % 4 == 0:
+            self.copy_h2d(buf, array)
+            return
+        # Pad the tail to a whole word
+        padded = bytearray((array.nbytes + 3) & ~3)
+        padded[:array.nbytes] = as_bytes(array)
+        self.copy_h2d(buf, padded)
+
+    def to_numpy(self, buf: Buffer, out: np.ndarray = None) -> np.ndarray:
+        # Reads straight into the array's memory when its size is whole words
+        assert buf.dtype is not None, "Buffer has no dtype, use copy_d2h."
+        if out is None:
+            import numpy as np
+            out = np.empty(buf.shape, buf.dtype)
+        assert out.flags.c_contiguous and out.nbytes == buf.nbytes, "Output array does not match the buffer."
+        if out.nbytes % 4 == 0:
+            self.copy_d2h(out, buf)
+        else:
+            padded = bytearray((out.nbytes + 3) & ~3)
+            self.copy_d2h(padded, buf)
+            as_bytes(out)[:] = padded[:out.nbytes]
+        return out
+
+    def free(self, buf):
+        with self.lock:
+            self.mem.free(buf)
+
+    def invalidate(self, buf):
+        with self.lock:
+            self.mem.invalidate(buf)
 
     def copy_h2d(self, dest, src:memoryview):
-        self.mem.copy_h2d(dest, src)
+        with self.lock:
+            self.mem.copy_h2d(dest, src)
 
     def copy_d2h(self, dest:memoryview, src):
-        self.mem.copy_d2h(dest, src)
+        with self.lock:
+            self.mem.copy_d2h(dest, src)
+
+    def gather(self, pairs: list, gap=None):
+        # Vectored copy_d2h: pairs of (device buffer, host view)
+        with self.lock:
+            self.mem.gather(pairs, gap)
+
+    def scatter(self, pairs: list, gap=None):
+        # Vectored copy_h2d: pairs of (device buffer, host view)
+        with self.lock:
+            self.mem.scatter(pairs, gap)
+
+    def fill(self, buf, value: int, width=4, timeout=None):
+        # Fills the buffer on the device with a repeated width byte value,
+        # only the kernel parameters cross the link
+        from bgpu_kernels import BLOCK_SIZE, builtin_program, grid_for
+        addr, size = buf
+        assert width in (1, 2, 4), f"Unsupported fill width: {width}"
+        assert size % width == 0 and addr % width == 0, f"Buffer at {addr:#010x} of {size} bytes is not aligned to the fill width {width}."
+        pattern = (value & ((1 << (width * 8)) - 1)).to_bytes(width, byteorder='little') * (4 // width)
+        # Whole words where possible, elements of the fill width otherwise
+        unit = 4 if size % 4 == 0 and addr % 4 == 0 else width
+        count = size // unit
+        if count == 0:
+            return
+
+        tblocks = grid_for(count, self.max_dispatch_blocks)
+        params = pack_words([addr, int.from_bytes(pattern[:unit], byteorder='little'), count, BLOCK_SIZE, tblocks * BLOCK_SIZE])
+        with self.lock:
+            self.launch(builtin_program("fill", unit), f"fill_{unit}", params, [buf], (tblocks, 1, 1), (BLOCK_SIZE, 1, 1), timeout)
+            # The device contents are known, later uploads only send the differences
+            self.mem.update_shadow(addr, pattern * (size // 4) + pattern[:size % 4])
+
+    def copy_d2d(self, dest, src, size=None, timeout=None):
+        # Copies between device buffers with built-in copy kernels, the data
+        # never crosses the link. Words where both sides are aligned, then
+        # half-word and byte tails.
+        from bgpu_kernels import BLOCK_SIZE, builtin_program, copy_segments, grid_for
+        dest_addr, dest_size = dest
+        src_addr, src_size = src
+        size = min(dest_size, src_size) if size is None else size
+        assert size <= dest_size and size <= src_size, "Copy is larger than the buffers."
+        assert dest_addr + size <= src_addr or src_addr + size <= dest_addr, "Source and destination overlap."
+
+        with self.lock:
+            known = self.mem.shadow_bytes(src_addr, size)
+            for offset, count, width in copy_segments(dest_addr, src_addr, size):
+                tblocks = grid_for(count, self.max_dispatch_blocks)
+                params = pack_words([dest_addr + offset, src_addr + offset, count, BLOCK_SIZE, tblocks * BLOCK_SIZE])
+                self.launch(builtin_program("copy", width), f"copy_{width}", params, [dest], (tblocks, 1, 1), (BLOCK_SIZE, 1, 1), timeout)
+            if known is not None:
+                self.mem.update_shadow(dest_addr, known)
+
+    def enable_profiling(self, profiler: BgpuProfiler = None) -> BgpuProfiler:
+        # Times the driver phases and every call on the connection
+        from bgpu_profiler import BgpuProfiler, ProfiledConnection
+        with self.lock:
+            self.disable_profiling()
+            self.profiler = BgpuProfiler() if profiler is None else profiler
+            self.set_connection(ProfiledConnection(self.con, self.profiler))
+            return self.profiler
+
+    def disable_profiling(self):
+        from bgpu_profiler import ProfiledConnection
+        with self.lock:
+            if isinstance(self.con, ProfiledConnection):
+                self.set_connection(self.con.con)
+            self.profiler = NULL_PROFILER
+            self.mem.profiler = NULL_PROFILER
+
+    def set_connection(self, con):
+        self.con = con
+        self.bgpu.con = con
+        self.mem.con = con
+        self.mem.profiler = self.profiler
+
+    def check_engine_free(self, what: str):
+        # Kernels, fills and device copies dispatch on the thread engine
+        assert self.persistent_queue is None, f"Cannot dispatch {what} while the persistent scheduler holds the thread engine, launch through the queue or stop it first."
+
+    def thread_engine_idle(self) -> bool:
+        # A persistent scheduler or a dispatch left running by a timeout or a
+        # cancelled wait keeps the thread engine busy
+        if self.persistent_queue is not None:
+            return False
+        try:
+            return not self.bgpu.dispatch_status()[1]
+        except RuntimeError:
+            # A failed threaded dispatch, its status read raises until the next one
+            return False
+
+    def expand_records(self, records: list[tuple[int, int, int]]):
+        # Writes (address, count, value) runs of repeated words on the device
+        # with the built-in expand kernel, records go to a scratch buffer
+        from bgpu_kernels import BLOCK_SIZE, builtin_program, grid_for
+        data = pack_words([v for record in records for v in record])
+        with self.lock:
+            scratch = self.alloc_evicting(len(data), Access.SCRATCH)
+            try:
+                self.con.write_block(scratch[0], data)
+                tblocks = grid_for(len(records), self.max_dispatch_blocks)
+                params = pack_words([scratch[0], len(records), BLOCK_SIZE, tblocks * BLOCK_SIZE])
+                self.launch(builtin_program("expand", 4), "expand", params, [], (tblocks, 1, 1), (BLOCK_SIZE, 1, 1))
+            finally:
+                self.mem.free(scratch)
+
+    def enable_autotuning(self, cache_path: str = None, metric='auto') -> Autotuner:
+        # Later run_kernel calls use the tuned configuration of a kernel and problem shape
+        from bgpu_autotune import Autotuner
+        self.autotuner = Autotuner(self, cache_path, metric)
+        return self.autotuner
+
+    def autotune(self, *args, global_size:tuple[int,int,int], local_size:tuple[int,int,int], program, function_name:str, access: list[Access] = None, args_for=None) -> dict:
+        if self.autotuner is None:
+            self.enable_autotuning()
+        return self.autotuner.tune(*args, global_size=global_size, local_size=local_size, program=program, function_name=function_name, access=access, args_for=args_for)
+
+    def stream(self) -> BgpuStream:
+        from bgpu_stream import BgpuStream
+        return BgpuStream(self)
+
+    def graph(self) -> BgpuGraph:
+        from bgpu_graph import BgpuGraph
+        return BgpuGraph(self)
+
+    def persistent(self, slots=16) -> PersistentQueue:
+        from bgpu_persistent import PersistentQueue
+        return PersistentQueue(self, slots)
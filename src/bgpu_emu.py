@@ -3,52 +3,80 @@ from bgpu_util import float_to_hex, hex_to_float
 from numpy import int32, uint32, float32
 import json
 import math
+import mmap
 
+import logging
 import os
+import threading
+
+logger = logging.getLogger("bgpu.emu")
+
+# Instruction level tracing, routed to the bgpu.emu logger
 cu_debug = os.getenv("BGPU_CU_DEBUG", "0") == "1"
+if cu_debug:
+    logger.setLevel(logging.DEBUG)
+    if not logger.hasHandlers():
+        logger.addHandler(logging.StreamHandler())
 
 class CU:
-    def __init__(self, warp_width=4):
+    def __init__(self, warp_width=4, trace=True):
         self.pc = [0] * warp_width # one pc per thread
         self.stopped = [False] * warp_width
         self.syncing = [False] * warp_width
         self.dp_addr = 0
         self.tb_id = 0
         self.tb_size = 0
+        # Launch geometry as written to the thread engine, 0 for 1D launches
+        self.grid_dims = 0
+        self.block_dims = 0
         self.num_regs = 256 # per thread
-        self.regs = [[int32(0)] * self.num_regs for _ in range(warp_width)]
+        # Register files are allocated by the first dispatch
+        self.regs = None
         self.warp_width = warp_width
 
+        # Long running kernels (e.g. persistent ones) can turn the register trace off
+        self.trace = trace
         self.reg_trace = {}
 
-    def dispatch_and_execute(self, pc, dp_addr, tblock_size, tblocks_to_dispatch, tgroup_id, memory):
-        print(f"Dispatching and executing: PC={pc:#010x}, DP_ADDR={dp_addr:#010x}, TblockSize={tblock_size}, Tblocks={tblocks_to_dispatch}, TGroupID={tgroup_id}")
+        # Performance counters: warp issue cycles and executed thread instructions
+        self.cycles = 0
+        self.instructions = 0
+
+    def dispatch_and_execute(self, pc, dp_addr, tblock_size, tblocks_to_dispatch, tgroup_id, memory, grid_dims=0, block_dims=0):
+        logger.debug("Dispatching and executing: PC=%#010x, DP_ADDR=%#010x, TblockSize=%d, Tblocks=%d, TGroupID=%d", pc, dp_addr, tblock_size, tblocks_to_dispatch, tgroup_id)
         self.tb_size = tblock_size
+        self.grid_dims = grid_dims
+        self.block_dims = block_dims
 
         assert tblock_size <= self.warp_width, "TBlock size exceeds warp width"
         assert tblock_size > 0, "TBlock size must be greater than zero"
+        if self.regs is None:
+            self.regs = [[int32(0)] * self.num_regs for _ in range(self.warp_width)]
         
+        report_progress = logger.isEnabledFor(logging.INFO)
         report_interval = tblocks_to_dispatch // 100 if tblocks_to_dispatch >= 100 else 1
         reg_traces_per_tblock = {}
         for tb in range(tblocks_to_dispatch):
             if cu_debug:
-                print(f"Executing TBlock {tb} with TGroupID {tgroup_id}")
-            elif (tb % report_interval) == 0:
-                print(f"  Executing TBlock {tb}/{tblocks_to_dispatch} ({(tb / tblocks_to_dispatch) * 100:.2f}%)")
+                logger.debug("Executing TBlock %d with TGroupID %d", tb, tgroup_id)
+            elif report_progress and (tb % report_interval) == 0:
+                logger.info("Executing TBlock %d/%d (%.2f%%)", tb, tblocks_to_dispatch, (tb / tblocks_to_dispatch) * 100)
             self.pc = [pc] * self.warp_width
             self.stopped = [False] * self.warp_width
             self.syncing = [False] * self.warp_width
             self.dp_addr = dp_addr
-            self.tb_id = tb
+            # The thread group ID offsets the block IDs of this dispatch
+            self.tb_id = tgroup_id + tb
 
             reg_traces_per_tblock[tb] = self.execute(memory)
         # Simulate execution logic here
-        print("Execution complete.")
+        logger.debug("Execution complete.")
 
-        with open(f"reg_trace.log", "w") as f:
-            json.dump(reg_traces_per_tblock, f, indent=4)
-            if cu_debug:
-                print(f"Register trace saved to reg_trace.log")
+        if self.trace:
+            with open(f"reg_trace.log", "w") as f:
+                json.dump(reg_traces_per_tblock, f, indent=4)
+                if cu_debug:
+                    logger.debug(f"Register trace saved to reg_trace.log")
 
     def decode_instruction(self, instruction):
         eu = EU(instruction >> 30) # Upper 2 bits for EU
@@ -71,20 +99,36 @@ class CU:
         op1 = instruction & 0xFF # Last 8 bits for operand 1
 
         if cu_debug:
-            print(f"Decoded instruction: EU={eu}, Subtype={subtype}, Dst={dst}, Op2={op2}, Op1={op1}")
+            logger.debug(f"Decoded instruction: EU={eu}, Subtype={subtype}, Dst={dst}, Op2={op2}, Op1={op1}")
 
         return eu, subtype, dst, op2, op1
 
+    def dim_index(self, linear, dim_x, dim_y, dim):
+        # Recovers the per-dimension index from a linearized ID, x varies fastest.
+        # A zero x extent marks a 1D launch.
+        if dim == 0:
+            return linear
+        if dim_x == 0:
+            return linear if dim == 1 else 0
+        if dim == 1:
+            return linear % dim_x
+        if dim == 2:
+            return (linear // dim_x) % dim_y
+        if dim == 3:
+            return linear // (dim_x * dim_y)
+        raise ValueError(f"Unknown special dimension: {dim}")
+
     def execute_iu(self, instruction, dst, op1, op2, tidx):
         if cu_debug:
-            print(f"Executing IU instruction: {instruction}, Dst=r{dst}, Op2={op2}, Op1={op1}")
+            logger.debug(f"Executing IU instruction: {instruction}, Dst=r{dst}, Op2={op2}, Op1={op1}")
 
         if instruction == IUSubtype.TID:
-            self.regs[tidx][dst] = tidx
+            # op1 selects the linear ID (0) or the x/y/z index (1-3)
+            self.regs[tidx][dst] = self.dim_index(tidx, self.block_dims & 0xFF, (self.block_dims >> 8) & 0xFF, op1)
         elif instruction == IUSubtype.WID:
             self.regs[tidx][dst] = 0 # We only emulate a single warp
         elif instruction == IUSubtype.BID:
-            self.regs[tidx][dst] = self.tb_id
+            self.regs[tidx][dst] = self.dim_index(self.tb_id, self.grid_dims & 0xFFFF, (self.grid_dims >> 16) & 0xFFFF, op1)
         elif instruction == IUSubtype.TBID:
             # self.regs[tidx][dst] = self.tb_id * self.warp_width + i
             raise NotImplementedError("TBID not fully implemented")
@@ -120,17 +164,17 @@ class CU:
                 try:
                     self.regs[tidx][dst] = self.regs[tidx][op2] * self.regs[tidx][op1]
                 except Exception as e:
-                    print(f"Error in MUL: r{op2}={self.regs[tidx][op2]}, r{op1}={self.regs[tidx][op1]}")
+                    logger.error("Error in MUL: r%d=%s, r%d=%s", op2, self.regs[tidx][op2], op1, self.regs[tidx][op1])
                     raise e
         elif instruction == IUSubtype.MULI:
             self.regs[tidx][dst] = self.regs[tidx][op2] * op1
         elif instruction == IUSubtype.CMPLT:
             if cu_debug:
-                print(f"Thread {tidx} CMPLT: r{op2}={self.regs[tidx][op2]} < r{op1}={self.regs[tidx][op1]}")
+                logger.debug(f"Thread {tidx} CMPLT: r{op2}={self.regs[tidx][op2]} < r{op1}={self.regs[tidx][op1]}")
             self.regs[tidx][dst] = 1 if self.regs[tidx][op2] < self.regs[tidx][op1] else 0
         elif instruction == IUSubtype.CMPNE:
             if cu_debug:
-                print(f"Thread {tidx} CMPNE: r{op2}={self.regs[tidx][op2]} != r{op1}={self.regs[tidx][op1]}")
+                logger.debug(f"Thread {tidx} CMPNE: r{op2}={self.regs[tidx][op2]} != r{op1}={self.regs[tidx][op1]}")
             self.regs[tidx][dst] = 1 if self.regs[tidx][op2] != self.regs[tidx][op1] else 0
         elif instruction == IUSubtype.DIV:
             import numpy as np
@@ -138,11 +182,11 @@ class CU:
                 try:
                     self.regs[tidx][dst] = self.regs[tidx][op2] / self.regs[tidx][op1]
                 except Exception as e:
-                    print(f"Error in DIV: r{op2}={self.regs[tidx][op2]}, r{op1}={self.regs[tidx][op1]}")
+                    logger.error("Error in DIV: r%d=%s, r%d=%s", op2, self.regs[tidx][op2], op1, self.regs[tidx][op1])
                     raise e
         elif instruction == IUSubtype.MAX:
             if cu_debug:
-                print(f"Thread {tidx} MAX: r{op2}={self.regs[tidx][op2]} , r{op1}={self.regs[tidx][op1]}")
+                logger.debug(f"Thread {tidx} MAX: r{op2}={self.regs[tidx][op2]} , r{op1}={self.regs[tidx][op1]}")
             self.regs[tidx][dst] = self.regs[tidx][op2] if self.regs[tidx][op2] > self.regs[tidx][op1] else self.regs[tidx][op1]
         else:
             raise ValueError(f"Unknown IU instruction: {instruction}") 
@@ -151,17 +195,17 @@ class CU:
         self.regs[tidx][dst] = int32(self.regs[tidx][dst])
 
         if cu_debug:
-            print(f"Thread {tidx} Dst=r{dst} set to {self.regs[tidx][dst]:#010x}, op2 if reg was r{op2}={self.regs[tidx][op2]:#010x}, op1 if reg was r{op1}={self.regs[tidx][op1]:#010x}")
+            logger.debug(f"Thread {tidx} Dst=r{dst} set to {self.regs[tidx][dst]:#010x}, op2 if reg was r{op2}={self.regs[tidx][op2]:#010x}, op1 if reg was r{op1}={self.regs[tidx][op1]:#010x}")
 
         # Increment the program counter
         self.pc[tidx] += 4
     
     def execute_lsu(self, instruction, dst, op1, op2, memory, tidx):
         if cu_debug:
-            print(f"Executing LSU instruction: {instruction}, Dst=r{dst}, Op2={op2}, Op1={op1}")
+            logger.debug(f"Executing LSU instruction: {instruction}, Dst=r{dst}, Op2={op2}, Op1={op1}")
         address = self.regs[tidx][op2]
         if instruction is not LSUSubtype.LOAD_PARAM and cu_debug:
-            print(f"Thread {tidx} accessing memory at address {address:#010x}")
+            logger.debug(f"Thread {tidx} accessing memory at address {address:#010x}")
 
         if instruction == LSUSubtype.LOAD_BYTE:
             if address < 0 or address >= len(memory):
@@ -178,7 +222,9 @@ class CU:
                 raise ValueError(f"Memory access out of bounds: {address:#010x}")
             if address % 4 != 0:
                 raise ValueError(f"Unaligned memory access: {address:#010x}")
-            unsigned = uint32(memory[address] | (memory[address + 1] << 8) | (memory[address + 2] << 16) | (memory[address + 3] << 24))
+            # Whole word slices, the host may access memory concurrently in threaded mode
+            b = memory[address:address + 4]
+            unsigned = uint32(b[0] | (b[1] << 8) | (b[2] << 16) | (b[3] << 24))
             self.regs[tidx][dst] = unsigned.view(int32)
         elif instruction == LSUSubtype.STORE_BYTE:
             data = self.regs[tidx][op1]
@@ -203,16 +249,13 @@ class CU:
                 raise ValueError(f"Memory access out of bounds: {address:#010x}")
             if address % 4 != 0:
                 raise ValueError(f"Unaligned memory access: {address:#010x}")
-            memory[address] = data & 0xFF
-            memory[address + 1] = (data >> 8) & 0xFF
-            memory[address + 2] = (data >> 16) & 0xFF
-            memory[address + 3] = (data >> 24) & 0xFF
+            memory[address:address + 4] = (int(data) & 0xFFFFFFFF).to_bytes(4, byteorder='little')
             # Clear the destination register
             self.regs[tidx][dst] = int32(0)
         elif instruction == LSUSubtype.LOAD_PARAM:
             address = self.dp_addr + op1 * 4
             if cu_debug:
-                print(f"Thread {tidx} loading parameter from address {address:#010x} = {self.dp_addr:#010x} + {op1 * 4:#010x}")
+                logger.debug(f"Thread {tidx} loading parameter from address {address:#010x} = {self.dp_addr:#010x} + {op1 * 4:#010x}")
 
             if address < 0 or address + 3 >= len(memory):
                 raise ValueError(f"Param memory access out of bounds: {address:#010x}")
@@ -224,14 +267,14 @@ class CU:
             raise NotImplementedError(f"LSU instruction {instruction} not implemented")
 
         if cu_debug:
-            print(f"Thread {tidx} Dst=r{dst} set to {self.regs[tidx][dst]:#010x}")
+            logger.debug(f"Thread {tidx} Dst=r{dst} set to {self.regs[tidx][dst]:#010x}")
 
         # Increment the program counter
         self.pc[tidx] += 4
 
     def execute_fpu(self, instruction, dst, op1, op2, tidx):
         if cu_debug:
-            print(f"Executing FPU instruction: {instruction}, Dst=r{dst}, Op2={op2}, Op1={op1}")
+            logger.debug(f"Executing FPU instruction: {instruction}, Dst=r{dst}, Op2={op2}, Op1={op1}")
 
         # Assume registers hold IEEE 754 float bit patterns
         op1_float = self.regs[tidx][op1].view(float32)
@@ -239,65 +282,65 @@ class CU:
         result = float32(0.0)
         if instruction == FPUSubtype.FADD:
             if cu_debug:
-                print(f"Thread {tidx} FADD: {op2_float} + {op1_float}")
+                logger.debug(f"Thread {tidx} FADD: {op2_float} + {op1_float}")
             result = op2_float + op1_float
             if cu_debug:
-                print(f"Thread {tidx} FADD result: {result}")
+                logger.debug(f"Thread {tidx} FADD result: {result}")
         elif instruction == FPUSubtype.FSUB:
             if cu_debug:
-                print(f"Thread {tidx} FSUB: {op2_float} - {op1_float}")
+                logger.debug(f"Thread {tidx} FSUB: {op2_float} - {op1_float}")
             result = op2_float - op1_float
             if cu_debug:
-                print(f"Thread {tidx} FSUB result: {result}")
+                logger.debug(f"Thread {tidx} FSUB result: {result}")
         elif instruction == FPUSubtype.FMUL:
             if cu_debug:
-                print(f"Thread {tidx} FMUL: {op2_float} * {op1_float}")
+                logger.debug(f"Thread {tidx} FMUL: {op2_float} * {op1_float}")
             result = op2_float * op1_float
             if cu_debug:
-                print(f"Thread {tidx} FMUL result: {result}")
+                logger.debug(f"Thread {tidx} FMUL result: {result}")
         elif instruction == FPUSubtype.FMAX:
             if cu_debug:
-                print(f"Thread {tidx} FMAX: {op2_float} {op1_float}")
+                logger.debug(f"Thread {tidx} FMAX: {op2_float} {op1_float}")
             result = op2_float if op2_float > op1_float else op1_float
             if cu_debug:
-                print(f"Thread {tidx} FMAX result: {result}")
+                logger.debug(f"Thread {tidx} FMAX result: {result}")
         elif instruction == FPUSubtype.FEXP2:
             if cu_debug:
-                print(f"Thread {tidx} FEXP2: 2^{op1_float}")
+                logger.debug(f"Thread {tidx} FEXP2: 2^{op1_float}")
             result = float32(2.0) ** op1_float
             if cu_debug:
-                print(f"Thread {tidx} FEXP2 result: {result}")
+                logger.debug(f"Thread {tidx} FEXP2 result: {result}")
         elif instruction == FPUSubtype.FRECIP:
             if cu_debug:
-                print(f"Thread {tidx} FRECIP: 1 / {op1_float}")
+                logger.debug(f"Thread {tidx} FRECIP: 1 / {op1_float}")
             result = float32(1.0) / op1_float
             if cu_debug:
-                print(f"Thread {tidx} FRECIP result: {result}")
+                logger.debug(f"Thread {tidx} FRECIP result: {result}")
         elif instruction == FPUSubtype.FLOG2:
             if cu_debug:
-                print(f"Thread {tidx} FLOG2: log2({op1_float})")
+                logger.debug(f"Thread {tidx} FLOG2: log2({op1_float})")
             result = float32(math.log2(op1_float))
             if cu_debug:
-                print(f"Thread {tidx} FLOG2 result: {result}")
+                logger.debug(f"Thread {tidx} FLOG2 result: {result}")
         elif instruction == FPUSubtype.FCMPLT:
             if cu_debug:
-                print(f"Thread {tidx} FCMPLT: {op2_float} < {op1_float}")
+                logger.debug(f"Thread {tidx} FCMPLT: {op2_float} < {op1_float}")
             result = 1 if op2_float < op1_float else 0
             if cu_debug:
-                print(f"Thread {tidx} FCMPLT result: {result}")
+                logger.debug(f"Thread {tidx} FCMPLT result: {result}")
             self.regs[tidx][dst] = int32(result)
         elif instruction == FPUSubtype.FCAST_FROM_INT:
             if cu_debug:
-                print(f"Thread {tidx} FCAST_FROM_INT: casting int {self.regs[tidx][op1]} to float")
+                logger.debug(f"Thread {tidx} FCAST_FROM_INT: casting int {self.regs[tidx][op1]} to float")
             result = float32(self.regs[tidx][op1])
             if cu_debug:
-                print(f"Thread {tidx} FCAST_FROM_INT result: {result}")
+                logger.debug(f"Thread {tidx} FCAST_FROM_INT result: {result}")
         elif instruction == FPUSubtype.FCAST_TO_INT:
             if cu_debug:
-                print(f"Thread {tidx} FCAST_TO_INT: casting float {op1_float} to int")
+                logger.debug(f"Thread {tidx} FCAST_TO_INT: casting float {op1_float} to int")
             result = int32(op1_float)
             if cu_debug:
-                print(f"Thread {tidx} FCAST_TO_INT result: {result}")
+                logger.debug(f"Thread {tidx} FCAST_TO_INT result: {result}")
         else:
             raise ValueError(f"Unknown FPU instruction: {instruction}") 
 
@@ -305,14 +348,14 @@ class CU:
             self.regs[tidx][dst] = result.view(int32)
 
         if cu_debug:
-            print(f"Thread {tidx} Dst=r{dst} set to {self.regs[tidx][dst]:#010x}, op2 if reg was r{op2}={self.regs[tidx][op2]:#010x}, op1 if reg was r{op1}={self.regs[tidx][op1]:#010x}")
+            logger.debug(f"Thread {tidx} Dst=r{dst} set to {self.regs[tidx][dst]:#010x}, op2 if reg was r{op2}={self.regs[tidx][op2]:#010x}, op1 if reg was r{op1}={self.regs[tidx][op1]:#010x}")
 
         # Increment the program counter
         self.pc[tidx] += 4
 
     def execute_bru(self, instruction, dst, op1, op2, tidx):
         if cu_debug:
-            print(f"Executing BRU instruction: {instruction}, Dst=r{dst}, Op2={op2}, Op1={op1}")
+            logger.debug(f"Executing BRU instruction: {instruction}, Dst=r{dst}, Op2={op2}, Op1={op1}")
 
         # sign extend op1 from 8 bits
         if op1 & 0x80:
@@ -320,14 +363,14 @@ class CU:
 
         if instruction == BRUSubtype.SYNC_THREADS:
             if cu_debug:
-                print("Syncing threads...")
+                logger.debug("Syncing threads...")
             # Set this thread as syncing
             self.syncing[tidx] = True
             # Check if all other threads are at a sync point
             num_syncing = sum(1 for s in self.syncing if s)
             if num_syncing == self.warp_width:
                 if cu_debug:
-                    print("All threads synced, continuing execution.")
+                    logger.debug("All threads synced, continuing execution.")
                 # All threads are syncing, clear the syncing flags and continue
                 for i in range(self.warp_width):
                     self.syncing[i] = False
@@ -336,20 +379,26 @@ class CU:
         elif instruction == BRUSubtype.BRZ:
             if self.regs[tidx][op2] == 0:
                 if cu_debug:
-                    print(f"BRZ taken: r{op2}={self.regs[tidx][op2]} == 0, jumping to pc+1+{op1}")
+                    logger.debug(f"BRZ taken: r{op2}={self.regs[tidx][op2]} == 0, jumping to pc+1+{op1}")
                 self.pc[tidx] += (op1 + 1) * 4
             else:
                 if cu_debug:
-                    print(f"BRZ not taken: r{op2}={self.regs[tidx][op2]} != 0, continuing")
+                    logger.debug(f"BRZ not taken: r{op2}={self.regs[tidx][op2]} != 0, continuing")
                 self.pc[tidx] += 4
+        elif instruction == BRUSubtype.JMP:
+            # Absolute jump to the byte address held in op2
+            target = int(self.regs[tidx][op2]) & 0xFFFFFFFF
+            if cu_debug:
+                logger.debug(f"JMP to r{op2}={target:#010x}")
+            self.pc[tidx] = target
         elif instruction == BRUSubtype.BRNZ:
             if self.regs[tidx][op2] != 0:
                 if cu_debug:
-                    print(f"BRNZ taken: r{op2}={self.regs[tidx][op2]} != 0, jumping to pc+1+{op1}")
+                    logger.debug(f"BRNZ taken: r{op2}={self.regs[tidx][op2]} != 0, jumping to pc+1+{op1}")
                 self.pc[tidx] += (op1 + 1) * 4
             else:
                 if cu_debug:
-                    print(f"BRNZ not taken: r{op2}={self.regs[tidx][op2]} == 0, continuing")
+                    logger.debug(f"BRNZ not taken: r{op2}={self.regs[tidx][op2]} == 0, continuing")
                 self.pc[tidx] += 4
         else:
             raise ValueError(f"Unknown BRU instruction: {instruction}") 
@@ -370,16 +419,18 @@ class CU:
 
         all_stopped = False
         while not all_stopped:
+            self.cycles += 1
             for tidx in range(self.tb_size):
                 instruction = self.read_instruction_memory(memory, self.pc[tidx])
                 if cu_debug:
-                    print(f"Thread {tidx} Executing instruction at PC={self.pc[tidx]:#010x}: {instruction:#010x}")
+                    logger.debug(f"Thread {tidx} Executing instruction at PC={self.pc[tidx]:#010x}: {instruction:#010x}")
 
                 eu, subtype, dst, op2, op1 = self.decode_instruction(instruction)
+                self.instructions += 1
 
                 if eu == EU.BRU and subtype == BRUSubtype.STOP:
                     if cu_debug:
-                        print("Stopping execution.")
+                        logger.debug("Stopping execution.")
                     self.stopped[tidx] = True
                 elif eu == EU.IU:
                     self.execute_iu(subtype, dst, op1, op2, tidx)
@@ -392,7 +443,7 @@ class CU:
                 else:
                     raise ValueError(f"Unknown EU: {eu}")
 
-                if self.syncing[tidx]:
+                if self.syncing[tidx] or not self.trace:
                     # If the thread is syncing, do not record register changes or increment timestamp
                     continue
 
@@ -417,7 +468,7 @@ class CU:
         return self.reg_trace
 
 class EmuJtag:
-    def __init__(self, memory_size=1 << 16, warp_width=4):
+    def __init__(self, memory_size=1 << 16, warp_width=4, threaded=False, trace=True):
         self.te_base = 0xFFFFFF00
         self.te_pc = 0
         self.te_dp_addr = 0
@@ -425,25 +476,37 @@ class EmuJtag:
         self.te_tblocks_to_dispatch = 0
         self.te_tgroup_id = 0
         self.te_status = 0
-
-        # Byte addressable memory
-        self.memory = [0] * memory_size
-
-        self.cu = CU(warp_width)
+        self.te_grid_dims = 0
+        self.te_block_dims = 0
+
+        # Byte addressable memory. Anonymous mappings read as zero and the OS
+        # only backs the pages that get written.
+        self.memory = mmap.mmap(-1, memory_size)
+
+        self.cu = CU(warp_width, trace)
+        # Threaded dispatches run in the background like on the hardware, the
+        # host keeps accessing memory and polls the status register
+        self.threaded = threaded
+        self.supports_persistent = threaded
+        # Grid and block dimension registers 6 and 7 for %g0-%g2/%l0-%l2
+        self.supports_launch_geometry = True
+        self.dispatcher = None
+        self.dispatch_error = None
+        self.dispatches = 0
+        # Accesses so far, the emulator does not batch: one per word or block
+        self.transactions = 0
 
     def write(self, address, data, check=True):
+        self.transactions += 1
         if address % 4 != 0:
             raise ValueError(f"Unaligned memory access at address {address:#010x}")
 
         if address >= 0 and address + 3 < len(self.memory):
             # print(f"Writing to address {address:#010x}: {data:#010x}")
-            self.memory[address] = data & 0xFF
-            self.memory[address + 1] = (data >> 8) & 0xFF
-            self.memory[address + 2] = (data >> 16) & 0xFF
-            self.memory[address + 3] = (data >> 24) & 0xFF
+            self.memory[address:address + 4] = (int(data) & 0xFFFFFFFF).to_bytes(4, byteorder='little')
             return
 
-        if address >= self.te_base and address < self.te_base + 6 * 4:
+        if address >= self.te_base and address < self.te_base + 8 * 4:
             # print(f"Writing to thread engine base address {self.te_base:#010x}")
             if address == self.te_base + 0 * 4:
                 self.te_pc = data
@@ -456,33 +519,92 @@ class EmuJtag:
             elif address == self.te_base + 4 * 4:
                 self.te_tblock_size = data
             elif address == self.te_base + 5 * 4:
-                # Execute the dispatch
-                self.cu.dispatch_and_execute(
-                    self.te_pc,
-                    self.te_dp_addr,
-                    self.te_tblock_size,
-                    self.te_tblocks_to_dispatch,
-                    self.te_tgroup_id,
-                    self.memory
-                )
-                # Update the status
-                self.te_status |= 1 << 2 # Finished bit
-                self.te_status |= self.te_tblocks_to_dispatch << 4 # Number of dispatched TBlocks
-                self.te_status |= self.te_tblocks_to_dispatch << 24 # Number of finished TBlocks
+                if not self.threaded:
+                    self.run_dispatch()
+                    return
+                if self.dispatcher is not None and self.dispatcher.is_alive():
+                    # The thread of a finished dispatch may still be on its way out
+                    if (self.te_status >> 2) & 1 == 0:
+                        raise ValueError("Dispatch started while the thread engine is running")
+                    self.dispatcher.join()
+                self.dispatch_error = None
+                self.te_status = 1 << 1 # Running bit
+                self.te_status |= (self.te_tblocks_to_dispatch & 0xF) << 4 # Number of dispatched TBlocks
+                self.dispatcher = threading.Thread(target=self.run_dispatch, daemon=True)
+                self.dispatcher.start()
+            elif address == self.te_base + 6 * 4:
+                self.te_grid_dims = data
+            elif address == self.te_base + 7 * 4:
+                self.te_block_dims = data
             return
 
         raise ValueError(f"Invalid address {address:#010x} for write operation, max_memory address is {len(self.memory) - 1:#010x}")
 
+    def run_dispatch(self):
+        # Execute the dispatch, the PC register holds a word address
+        self.dispatches += 1
+        try:
+            self.cu.dispatch_and_execute(
+                self.te_pc * 4,
+                self.te_dp_addr,
+                self.te_tblock_size,
+                self.te_tblocks_to_dispatch,
+                self.te_tgroup_id,
+                self.memory,
+                self.te_grid_dims,
+                self.te_block_dims
+            )
+        except Exception as e:
+            if not self.threaded:
+                raise
+            logger.error("Threaded dispatch failed: %s", e)
+            self.dispatch_error = e
+            return
+        # Update the status, the counters are 4-bit fields
+        status = 1 << 2 # Finished bit
+        status |= (self.te_tblocks_to_dispatch & 0xF) << 4 # Number of dispatched TBlocks
+        status |= (self.te_tblocks_to_dispatch & 0xF) << 24 # Number of finished TBlocks
+        self.te_status = status
+
+    def perf_counters(self) -> dict:
+        return {'cycles': self.cu.cycles, 'instructions': self.cu.instructions, 'dispatches': self.dispatches}
+
+    def reset_perf_counters(self):
+        self.cu.cycles = 0
+        self.cu.instructions = 0
+        self.dispatches = 0
+
+    def write_block(self, address, data: bytes, check=True):
+        self.transactions += 1
+        if address < 0 or address + len(data) > len(self.memory):
+            raise ValueError(f"Invalid block write of {len(data)} bytes at address {address:#010x}")
+        self.memory[address:address + len(data)] = data
+
+    def read_block(self, address, size) -> bytes:
+        self.transactions += 1
+        if address < 0 or address + size > len(self.memory):
+            raise ValueError(f"Invalid block read of {size} bytes at address {address:#010x}")
+        return bytes(self.memory[address:address + size])
+
+    def write_many(self, writes: list[tuple[int, int]], check=True):
+        for address, data in writes:
+            self.write(address, data, check)
+
+    def read_many(self, addresses: list[int]) -> list[int]:
+        return [self.read(address) for address in addresses]
+
     def read(self, address):
+        self.transactions += 1
         if address % 4 != 0:
             raise ValueError(f"Unaligned memory access at address {address:#010x}")
 
         if address >= 0 and address + 3 < len(self.memory):
-            value = self.memory[address] | (self.memory[address + 1] << 8) | (self.memory[address + 2] << 16) | (self.memory[address + 3] << 24)
+            b = self.memory[address:address + 4]
+            value = b[0] | (b[1] << 8) | (b[2] << 16) | (b[3] << 24)
             # print(f"Reading from address {address:#010x}: {value:#010x}")
             return value
 
-        if address >= self.te_base and address < self.te_base + 6 * 4:
+        if address >= self.te_base and address < self.te_base + 8 * 4:
             # print(f"Reading from thread engine base address {self.te_base:#010x}")
             if address == self.te_base + 0 * 4:
                 return self.te_pc
@@ -495,6 +617,12 @@ class EmuJtag:
             elif address == self.te_base + 4 * 4:
                 return self.te_tblock_size
             elif address == self.te_base + 5 * 4:
+                if self.dispatch_error is not None:
+                    raise RuntimeError(f"Threaded dispatch failed: {self.dispatch_error}")
                 return self.te_status
+            elif address == self.te_base + 6 * 4:
+                return self.te_grid_dims
+            elif address == self.te_base + 7 * 4:
+                return self.te_block_dims
 
         raise ValueError(f"Invalid address {address:#010x}")
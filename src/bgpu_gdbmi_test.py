@@ -0,0 +1,82 @@
+import time
+
+import numpy as np
+import pytest
+
+from bgpu_assembler import BGPUAssembler
+from bgpu_driver import BGPUDriver
+from bgpu_emu import EmuJtag
+from bgpu_jtag import FakeGdbController, GdbJtag, GdbMiError
+
+affine_asm = """
+affine:
+        ldparam.int32 r0, 0
+        ldparam.int32 r1, 1
+        ldparam.int32 r2, 2
+        special r3, %g
+        special r4, %l
+        shl.ri.int32 r3, r3, 2
+        add.rr.int32 r3, r3, r4
+        mul.rr.int32 r5, r3, r1
+        add.rr.int32 r5, r5, r2
+        shl.ri.int32 r3, r3, 2
+        add.rr.int32 r3, r0, r3
+        st.int32.global r3, r5
+        stop
+"""
+
+def test_pipelined_reads_hide_latency():
+    latency = 0.05
+    con = GdbJtag(gdb=FakeGdbController(EmuJtag(trace=False), latency=latency), window=32)
+    con.write_block(0, bytes(range(64)), check=False)
+    start = time.monotonic()
+    values = con.read_many(list(range(0, 64, 4)))
+    elapsed = time.monotonic() - start
+    con.close()
+    assert values == [int.from_bytes(bytes(range(i, i + 4)), byteorder='little') for i in range(0, 64, 4)]
+    # 16 reads in flight together cost about one round trip, not 16
+    assert elapsed < 4 * latency
+
+def test_window_bounds_commands_in_flight():
+    latency = 0.05
+    con = GdbJtag(gdb=FakeGdbController(EmuJtag(trace=False), latency=latency), window=4)
+    start = time.monotonic()
+    con.read_many(list(range(0, 64, 4)))
+    elapsed = time.monotonic() - start
+    con.close()
+    # At most 4 of the 16 reads are outstanding at any time
+    assert elapsed >= 4 * latency * 0.9
+
+def test_driver_runs_kernel_through_fake():
+    driver = BGPUDriver(backend='gdb', gdb=FakeGdbController(EmuJtag(trace=False), latency=0.001))
+    program = bytes(BGPUAssembler().assemble_lines(affine_asm.splitlines()))
+    out = driver.empty(64, np.int32)
+    driver.run_kernel([out, 3, 1], global_size=(16, 1, 1), local_size=(4, 1, 1), program=program, function_name="affine", timeout=10)
+    assert (driver.to_numpy(out) == np.arange(64) * 3 + 1).all()
+    driver.con.close()
+
+def test_error_response_fails_command():
+    con = GdbJtag(gdb=FakeGdbController(EmuJtag(memory_size=64, trace=False)))
+    with pytest.raises(GdbMiError):
+        con.read_block(0x1000, 8)
+    con.close()
+
+class DyingGdbController(FakeGdbController):
+    def get_gdb_response(self, timeout_sec=1.0, raise_error_on_timeout=True):
+        raise OSError("gdb exited")
+
+def test_reader_failure_fails_pending_commands():
+    con = GdbJtag(gdb=DyingGdbController(EmuJtag(trace=False), latency=10.0), timeout=None)
+    with pytest.raises(GdbMiError):
+        con.read(0)
+    # Commands after the failure are rejected right away
+    with pytest.raises(GdbMiError):
+        con.read(0)
+
+def test_wait_times_out():
+    con = GdbJtag(gdb=FakeGdbController(EmuJtag(trace=False), latency=1.0), timeout=0.1)
+    start = time.monotonic()
+    with pytest.raises(GdbMiError):
+        con.read(0)
+    assert time.monotonic() - start < 0.5
+    con.close()
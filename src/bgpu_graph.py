@@ -0,0 +1,94 @@
+import logging
+import time
+
+logger = logging.getLogger("bgpu.graph")
+
+class GraphLaunch:
+    def __init__(self, function_name: str, image, pc: int, dp_addr: int, tblock_size: int, num_blocks: int, global_size, local_size, written: list, stats):
+        self.function_name = function_name
+        self.image = image
+        self.pc = pc
+        self.dp_addr = dp_addr
+        self.tblock_size = tblock_size
+        self.num_blocks = num_blocks
+        self.global_size = global_size
+        self.local_size = local_size
+        self.written = written
+        self.stats = stats
+
+class BgpuGraph:
+    # Records a fixed sequence of copies and launches once. Kernel images and
+    # parameter blocks are resolved and uploaded at capture time into memory
+    # owned by the graph, so a replay only sends the changed input words, the
+    # dispatch register writes and the output reads.
+    def __init__(self, driver):
+        self.driver = driver
+        self.nodes = []
+        self.images = []
+        self.replays = 0
+
+    def copy_h2d(self, dest, src: memoryview, static=False):
+        # Static data is uploaded now, other inputs are read from src on every replay
+        if static:
+            self.driver.copy_h2d(dest, src)
+            return
+        self.nodes.append(('h2d', dest, src))
+
+    def copy_d2h(self, dest: memoryview, src):
+        self.nodes.append(('d2h', dest, src))
+
+    def run_kernel(self, *args, global_size:tuple[int,int,int], local_size:tuple[int,int,int], program, function_name:str, access: list = None):
+        # Buffers the kernel may write lose their host shadow on replay, access
+        # qualifies the arguments like BGPUDriver.run_kernel
+        arg_bufs = args[0]
+        program = bytes(program)
+        assert len(program) % 4 == 0, "Kernel program size must be a multiple of 4 bytes."
+        assert len(global_size) == 3 and len(local_size) == 3, "Global and local sizes must be 3-tuples."
+        self.driver.bgpu.launch_dims(global_size, local_size)
+        with self.driver.lock:
+            image_data = program + self.driver.pack_params(arg_bufs)
+            image = self.driver.alloc_evicting(len(image_data))
+            self.driver.mem.copy_h2d(image, memoryview(image_data))
+            stats = self.driver.stats_for(program, function_name)
+            written = self.driver.written_args(arg_bufs, access)
+        self.images.append(image)
+
+        launch = GraphLaunch(
+            function_name, image, image[0], image[0] + len(program),
+            local_size[0] * local_size[1] * local_size[2],
+            global_size[0] * global_size[1] * global_size[2],
+            global_size, local_size,
+            written, stats
+        )
+        self.nodes.append(('launch', launch))
+        logger.debug("Captured launch of %s with image at %#010x.", function_name, image[0])
+
+    def replay(self, timeout=None) -> dict:
+        driver = self.driver
+        start = time.monotonic()
+        launches = []
+        with driver.lock:
+            if any(node[0] == 'launch' for node in self.nodes):
+                driver.check_engine_free("a graph")
+            for node in self.nodes:
+                if node[0] == 'h2d':
+                    driver.mem.copy_h2d(node[1], node[2])
+                elif node[0] == 'd2h':
+                    driver.mem.copy_d2h(node[1], node[2])
+                else:
+                    launch = node[1]
+                    for buf in launch.written:
+                        driver.mem.invalidate(buf)
+                    driver.bgpu.set_launch_geometry(launch.global_size, launch.local_size)
+                    metrics = driver.dispatch_chunked(launch.pc, launch.dp_addr, launch.tblock_size, 0, launch.num_blocks, launch.stats, timeout)
+                    launch.stats.record(metrics)
+                    driver.last_launch = metrics
+                    launches.append(metrics)
+        self.replays += 1
+        return {'latency': time.monotonic() - start, 'launches': launches}
+
+    def free(self):
+        for image in self.images:
+            self.driver.free(image)
+        self.images = []
+        self.nodes = []
@@ -1,29 +1,246 @@
 #!/usr/bin/env python3
 
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
 from pygdbmi.gdbcontroller import GdbController
 
+class GdbMiError(Exception):
+    pass
+
+class GdbMiChannel:
+    # Sends token-tagged MI commands without waiting for their responses.
+    # A reader thread matches result records to the pending futures by token.
+    # Waiting for a response gives up after timeout seconds (None waits forever).
+    def __init__(self, gdb, window=32, poll_interval=0.05, timeout=30.0):
+        self.gdb = gdb
+        self.window = threading.BoundedSemaphore(window)
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.pending = {}
+        self.next_token = 1
+        self.lock = threading.Lock()
+        self.closed = False
+        # Set when the reader thread died, later commands fail right away
+        self.error = None
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+
+    def submit(self, command: str) -> Future:
+        assert not self.closed, "MI channel is closed."
+        # Bound the number of commands in flight so gdb is not overrun
+        self.window.acquire()
+        future = Future()
+        with self.lock:
+            if self.error is not None:
+                self.window.release()
+                raise GdbMiError(f"MI channel failed: {self.error}")
+            token = self.next_token
+            self.next_token += 1
+            self.pending[token] = future
+            self.gdb.write(f"{token}{command}", read_response=False)
+        return future
+
+    def submit_many(self, commands: list[str]) -> list[Future]:
+        return [self.submit(command) for command in commands]
+
+    def execute(self, command: str, timeout=None):
+        return self.wait([self.submit(command)], timeout)[0]
+
+    async def execute_async(self, command: str):
+        return await asyncio.wrap_future(self.submit(command))
+
+    def wait(self, futures: list[Future], timeout=None) -> list:
+        # The timeout covers all futures together, it defaults to the channel's
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        results = []
+        for future in futures:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                results.append(future.result(remaining))
+            except TimeoutError:
+                raise GdbMiError(f"No MI response within {timeout} s") from None
+        return results
+
+    def fail_pending(self, error: Exception):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        for future in pending.values():
+            self.window.release()
+            future.set_exception(error)
+
+    def read_loop(self):
+        while not self.closed:
+            try:
+                responses = self.gdb.get_gdb_response(timeout_sec=self.poll_interval, raise_error_on_timeout=False)
+            except Exception as e:
+                # gdb went away, nothing will answer the commands in flight
+                with self.lock:
+                    self.error = e
+                self.fail_pending(GdbMiError(f"MI reader stopped: {e}"))
+                return
+            for resp in responses:
+                if resp['type'] != 'result' or resp.get('token') is None:
+                    continue
+                with self.lock:
+                    future = self.pending.pop(resp['token'], None)
+                if future is None:
+                    continue
+                self.window.release()
+                if resp['message'] == 'error':
+                    future.set_exception(GdbMiError(f"MI command {resp['token']} failed: {resp['payload']}"))
+                else:
+                    future.set_result(resp['payload'])
+
+    def close(self):
+        self.closed = True
+        self.reader.join()
+        self.fail_pending(GdbMiError("MI channel closed with commands in flight."))
+
+class FakeGdbController:
+    # Stand-in for GdbController that serves MI memory commands from a local
+    # target (e.g. EmuJtag) and delays every response by a fixed latency.
+    def __init__(self, target, latency=0.0, service_time=0.0):
+        self.target = target
+        self.latency = latency
+        self.service_time = service_time
+        self.responses = deque()
+        self.last_ready = 0.0
+        self.cond = threading.Condition()
+
+    def execute(self, command: str):
+        # Aligned words go through the target's word access, it also serves
+        # the thread engine registers outside the memory
+        parts = command.split()
+        if parts[0] == '-data-write-memory-bytes':
+            address = int(parts[1], 0)
+            data = bytes.fromhex(parts[2])
+            if len(data) == 4 and address % 4 == 0:
+                self.target.write(address, int.from_bytes(data, byteorder='little'), check=False)
+            else:
+                self.target.write_block(address, data, check=False)
+            return 'done', None
+        if parts[0] == '-data-read-memory-bytes':
+            address = int(parts[1], 0)
+            count = int(parts[2], 0)
+            if count == 4 and address % 4 == 0:
+                contents = self.target.read(address).to_bytes(4, byteorder='little').hex()
+            else:
+                contents = self.target.read_block(address, count).hex()
+            return 'done', {'memory': [{'begin': f"{address:#x}", 'offset': '0x0', 'end': f"{address + count:#x}", 'contents': contents}]}
+        return 'error', {'msg': f"Undefined MI command: {parts[0]}"}
+
+    def write(self, mi_cmd_to_write, timeout_sec=None, raise_error_on_timeout=True, read_response=True):
+        token_len = len(mi_cmd_to_write) - len(mi_cmd_to_write.lstrip('0123456789'))
+        token = int(mi_cmd_to_write[:token_len]) if token_len > 0 else None
+        try:
+            message, payload = self.execute(mi_cmd_to_write[token_len:])
+        except (ValueError, RuntimeError) as e:
+            message, payload = 'error', {'msg': str(e)}
+        resp = {'type': 'result', 'message': message, 'payload': payload, 'token': token, 'stream': 'stdout'}
+
+        with self.cond:
+            ready = max(time.monotonic() + self.latency, self.last_ready + self.service_time)
+            self.last_ready = ready
+            self.responses.append((ready, resp))
+            self.cond.notify_all()
+
+        if read_response:
+            return self.get_gdb_response(timeout_sec=self.latency + 1.0)
+        return []
+
+    def get_gdb_response(self, timeout_sec=1.0, raise_error_on_timeout=True):
+        deadline = time.monotonic() + timeout_sec
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                if len(self.responses) > 0 and self.responses[0][0] <= now:
+                    ready = []
+                    while len(self.responses) > 0 and self.responses[0][0] <= now:
+                        ready.append(self.responses.popleft()[1])
+                    return ready
+                if now >= deadline:
+                    if raise_error_on_timeout:
+                        raise TimeoutError("Did not get response from fake gdb")
+                    return []
+                wake = deadline if len(self.responses) == 0 else min(deadline, self.responses[0][0])
+                self.cond.wait(wake - now)
+
 class GdbJtag:
-    def __init__(self):
-        import sys
-        bin = 'gdb' if sys.platform == 'darwin' else 'gdb-multiarch'
-        self.gdb = GdbController([bin, '--interpreter=mi3', '--nx', '--quiet'])
-        self.gdb.write('target extended-remote :3333')
+    def __init__(self, gdb=None, window=32, max_block=1024, timeout=30.0):
+        if gdb is None:
+            import sys
+            bin = 'gdb' if sys.platform == 'darwin' else 'gdb-multiarch'
+            gdb = GdbController([bin, '--interpreter=mi3', '--nx', '--quiet'])
+            gdb.write('target extended-remote :3333')
+        self.gdb = gdb
+        self.max_block = max_block
+        self.channel = GdbMiChannel(self.gdb, window, timeout=timeout)
+        # MI commands sent so far, every access and block chunk is one command
+        self.transactions = 0
+
+    def submit_write(self, address, data: bytes) -> Future:
+        self.transactions += 1
+        return self.channel.submit(f"-data-write-memory-bytes {address:#010x} {bytes(data).hex()}")
+
+    def submit_read(self, address, size) -> Future:
+        self.transactions += 1
+        return self.channel.submit(f"-data-read-memory-bytes {address:#010x} {size}")
+
+    def read_result(self, payload) -> bytes:
+        data = bytearray()
+        for region in payload['memory']:
+            data.extend(bytes.fromhex(region['contents']))
+        return bytes(data)
 
     def write(self, address, data, check=True):
-        command = f"set *{address:#010x} = {data:#010x}"
-        resp = self.gdb.write(command)
-        assert resp[1]['message'] == 'memory-changed', "Memory write failed: " + str(resp)
+        self.channel.wait([self.submit_write(address, data.to_bytes(4, byteorder='little'))])
 
-        read_value = self.read(address)
-        if check and read_value != data:
-            raise ValueError(f"Data mismatch at address {address:#010x}: expected {data:#010x}, got {read_value:#010x}")
+        if check:
+            read_value = self.read(address)
+            if read_value != data:
+                raise ValueError(f"Data mismatch at address {address:#010x}: expected {data:#010x}, got {read_value:#010x}")
 
     def read(self, address):
-        command = f"x {address:#010x}"
-        resp = self.gdb.write(command)
-        assert resp[1]['message'] == None, "Memory read failed: " + str(resp)
-        value = None
-        for r in resp:
-            if r['payload'] is not None and not r['payload'].startswith("x "):
-                value = int(r['payload'].split('\t')[1], 16)
-        return value
+        data = self.read_result(self.channel.wait([self.submit_read(address, 4)])[0])
+        return int.from_bytes(data, byteorder='little')
+
+    def write_block(self, address, data: bytes, check=True):
+        futures = []
+        for offset in range(0, len(data), self.max_block):
+            futures.append(self.submit_write(address + offset, data[offset:offset + self.max_block]))
+        self.channel.wait(futures)
+
+        if check:
+            read_back = self.read_block(address, len(data))
+            if read_back != bytes(data):
+                raise ValueError(f"Data mismatch in block at address {address:#010x} of size {len(data)} bytes")
+
+    def read_block(self, address, size) -> bytes:
+        futures = []
+        for offset in range(0, size, self.max_block):
+            futures.append(self.submit_read(address + offset, min(self.max_block, size - offset)))
+        return b''.join(self.read_result(payload) for payload in self.channel.wait(futures))
+
+    def write_many(self, writes: list[tuple[int, int]], check=True):
+        # Queue all word writes and wait once
+        futures = [self.submit_write(address, data.to_bytes(4, byteorder='little')) for address, data in writes]
+        self.channel.wait(futures)
+
+        if check:
+            read_values = self.read_many([address for address, _ in writes])
+            for (address, data), read_value in zip(writes, read_values):
+                if read_value != data:
+                    raise ValueError(f"Data mismatch at address {address:#010x}: expected {data:#010x}, got {read_value:#010x}")
+
+    def read_many(self, addresses: list[int]) -> list[int]:
+        futures = [self.submit_read(address, 4) for address in addresses]
+        return [int.from_bytes(self.read_result(payload), byteorder='little') for payload in self.channel.wait(futures)]
+
+    def close(self):
+        self.channel.close()
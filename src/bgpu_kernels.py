@@ -0,0 +1,250 @@
+from bgpu_instructions import BRUSubtype, EU, IUSubtype, LSUSubtype
+
+# Built-in kernels used by the driver. They run as a grid-stride loop, so a
+# single dispatch of at most max_dispatch_blocks TBlocks covers any size.
+BLOCK_SIZE = 4
+
+DTYPES = {1: "uint8", 2: "uint16", 4: "int32"}
+SHIFTS = {1: 0, 2: 1, 4: 2}
+
+# Params: 0 destination, 1 value, 2 element count, 3 TBlock size, 4 total threads
+fill_asm = """
+fill_{width}:
+        ldparam.int32 r0, 0
+        ldparam.int32 r1, 1
+        ldparam.int32 r2, 2
+        ldparam.int32 r3, 3
+        ldparam.int32 r4, 4
+        special r5, %g
+        special r6, %l
+        mul.rr.int32 r5, r5, r3
+        add.rr.int32 r5, r5, r6
+fill_loop:
+        cmplt.rr.int32 r7, r5, r2
+        br.ez.fill_done r7
+        shl.ri.int32 r8, r5, {shift}
+        add.rr.int32 r8, r0, r8
+        st.{dtype}.global r8, r1
+        add.rr.int32 r5, r5, r4
+        br.nz.fill_loop r7
+fill_done:
+        stop
+"""
+
+# Params: 0 destination, 1 source, 2 element count, 3 TBlock size, 4 total threads
+copy_asm = """
+copy_{width}:
+        ldparam.int32 r0, 0
+        ldparam.int32 r1, 1
+        ldparam.int32 r2, 2
+        ldparam.int32 r3, 3
+        ldparam.int32 r4, 4
+        special r5, %g
+        special r6, %l
+        mul.rr.int32 r5, r5, r3
+        add.rr.int32 r5, r5, r6
+copy_loop:
+        cmplt.rr.int32 r7, r5, r2
+        br.ez.copy_done r7
+        shl.ri.int32 r8, r5, {shift}
+        add.rr.int32 r9, r1, r8
+        ld.{dtype}.global r10, r9
+        add.rr.int32 r8, r0, r8
+        st.{dtype}.global r8, r10
+        add.rr.int32 r5, r5, r4
+        br.nz.copy_loop r7
+copy_done:
+        stop
+"""
+
+# Params: 0 record array, 1 record count, 2 TBlock size, 3 total threads.
+# Each record is (address, word count, value), one thread expands a record.
+expand_asm = """
+expand:
+        ldparam.int32 r0, 0
+        ldparam.int32 r1, 1
+        ldparam.int32 r2, 2
+        ldparam.int32 r3, 3
+        special r4, %g
+        special r5, %l
+        mul.rr.int32 r4, r4, r2
+        add.rr.int32 r4, r4, r5
+record_loop:
+        cmplt.rr.int32 r6, r4, r1
+        br.ez.expand_done r6
+        mul.ri.int32 r7, r4, 12
+        add.rr.int32 r7, r0, r7
+        ld.int32.global r8, r7
+        add.ri.int32 r7, r7, 4
+        ld.int32.global r9, r7
+        add.ri.int32 r7, r7, 4
+        ld.int32.global r10, r7
+word_loop:
+        br.ez.word_done r9
+        mov.rr.int32 r11, r8
+        st.int32.global r11, r10
+        add.ri.int32 r8, r8, 4
+        sub.ri.int32 r9, r9, 1
+        br.nz.word_loop r9
+word_done:
+        add.rr.int32 r4, r4, r3
+        br.nz.record_loop r6
+expand_done:
+        stop
+"""
+
+# Persistent mode mailbox, in words from its base address:
+#   0            head: sequence number of the newest posted descriptor
+#   1            reserved
+#   2 .. 2+T-1   done[t]: last sequence number finished by thread t
+#   2+T ..       ring of descriptor slots, sequence number s uses slot s & (slots - 1)
+# A slot holds (entry PC in bytes, parameter block address, first block,
+# block count, TBlock size, 3 reserved words) followed by the parameter
+# block itself. An entry PC of 0 stops the scheduler.
+PERSISTENT_DESCRIPTOR_WORDS = 8
+PERSISTENT_MAX_PARAMS = 16
+PERSISTENT_SLOT_BYTES = (PERSISTENT_DESCRIPTOR_WORDS + PERSISTENT_MAX_PARAMS) * 4
+
+# Registers r238-r254 belong to the scheduler, persistent kernels find their
+# parameter block in r252, their block ID in r253 and the return address in r254
+PERSISTENT_FIRST_REG = 238
+PARAM_REG = 252
+BLOCK_REG = 253
+RETURN_REG = 254
+
+# Params: 0 mailbox, 1 byte address of block_next, 2 slot index mask
+scheduler_asm = """
+scheduler:
+        ldparam.int32 r240, 0
+        ldparam.int32 r243, 1
+        ldparam.int32 r239, 2
+        special r242, %l
+        mov.ri.int32 r241, 0
+poll:
+        ld.int32.global r244, r240
+        sub.rr.int32 r245, r244, r241
+        br.ez.poll r245
+        add.ri.int32 r241, r241, 1
+        and.rr.int32 r246, r241, r239
+        mul.ri.int32 r246, r246, {slot_bytes}
+        add.rr.int32 r246, r246, r240
+        add.ri.int32 r246, r246, {ring_offset}
+        ld.int32.global r247, r246
+        br.ez.exit r247
+        add.ri.int32 r245, r246, 4
+        ld.int32.global r252, r245
+        add.ri.int32 r245, r246, 8
+        ld.int32.global r248, r245
+        add.ri.int32 r245, r246, 12
+        ld.int32.global r249, r245
+        add.ri.int32 r245, r246, 16
+        ld.int32.global r238, r245
+        cmplt.rr.int32 r250, r242, r238
+        br.ez.desc_done r250
+        add.rr.int32 r249, r249, r248
+block_loop:
+        cmplt.rr.int32 r250, r248, r249
+        br.ez.desc_done r250
+        mov.rr.int32 r253, r248
+        mov.rr.int32 r254, r243
+        jmp r247
+block_next:
+        add.ri.int32 r248, r248, 1
+        br.nz.block_loop r250
+desc_done:
+        shl.ri.int32 r251, r242, 2
+        add.rr.int32 r251, r251, r240
+        add.ri.int32 r251, r251, 8
+        st.int32.global r251, r241
+        br.nz.poll r241
+exit:
+        stop
+"""
+
+programs = {}
+labels = {}
+
+def builtin_program(name: str, width: int) -> bytes:
+    # Assembled once per process, the driver's kernel cache keeps them resident
+    key = (name, width)
+    program = programs.get(key)
+    if program is None:
+        assert width in DTYPES, f"Unsupported element width: {width}"
+        # The assembler is only loaded by processes that use built-in kernels
+        from bgpu_assembler import BGPUAssembler
+        source = {"fill": fill_asm, "copy": copy_asm, "expand": expand_asm, "scheduler": scheduler_asm}[name].format(
+            width=width, dtype=DTYPES[width], shift=SHIFTS[width],
+            slot_bytes=PERSISTENT_SLOT_BYTES, ring_offset=(2 + BLOCK_SIZE) * 4)
+        assembler = BGPUAssembler()
+        program = bytes(assembler.assemble_lines(source.splitlines()))
+        programs[key] = program
+        labels[key] = dict(assembler.executions_units[2].label_addresses)
+    return program
+
+def builtin_label(name: str, width: int, label: str) -> int:
+    # Byte offset of a label in a built-in program
+    builtin_program(name, width)
+    return labels[(name, width)][label] * 4
+
+def grid_for(count: int, max_blocks: int) -> int:
+    return max(1, min(max_blocks, (count + BLOCK_SIZE - 1) // BLOCK_SIZE))
+
+def copy_segments(dst: int, src: int, size: int) -> list[tuple[int, int, int]]:
+    # (offset, count, width) runs: single narrow accesses up to the first
+    # address aligned to the widest width both sides share, that width for
+    # the bulk, narrower ones for the tail
+    common = next(width for width in (4, 2, 1) if (dst - src) % width == 0)
+    segments = []
+    offset = 0
+    while offset < size:
+        width = next(width for width in (4, 2, 1) if width <= common and (dst + offset) % width == 0 and size - offset >= width)
+        count = (size - offset) // width if (dst + offset) % common == 0 else 1
+        segments.append((offset, count, width))
+        offset += count * width
+    return segments
+
+def encode(eu: EU, subtype, dst=0, op2=0, op1=0) -> int:
+    return eu.value << 30 | subtype.value << 24 | dst << 16 | op2 << 8 | op1
+
+def make_persistent(program: bytes) -> bytes:
+    # Rewrites a kernel's machine code to run under the persistent scheduler:
+    # ldparam reads from the block in r252, %g becomes r253 and stop returns
+    # to the scheduler through r254. Branch offsets are relocated.
+    assert len(program) % 4 == 0, "Kernel program size must be a multiple of 4 bytes."
+    words = [int.from_bytes(program[i:i+4], byteorder='little') for i in range(0, len(program), 4)]
+    out = []
+    index_map = []
+    branches = []
+    for i, word in enumerate(words):
+        index_map.append(len(out))
+        eu = EU(word >> 30)
+        subtype = (word >> 24) & 0x3F
+        dst = (word >> 16) & 0xFF
+        op1 = word & 0xFF
+        if eu != EU.BRU:
+            assert dst < PERSISTENT_FIRST_REG, f"Instruction {i} writes r{dst}, reserved for the persistent scheduler."
+
+        if eu == EU.LSU and subtype == LSUSubtype.LOAD_PARAM.value:
+            assert op1 * 4 <= 0xFF, f"Parameter {op1} is out of reach in persistent mode."
+            out.append(encode(EU.IU, IUSubtype.ADDI, dst, PARAM_REG, op1 * 4))
+            out.append(encode(EU.LSU, LSUSubtype.LOAD_WORD, dst, dst, dst))
+        elif eu == EU.IU and subtype == IUSubtype.BID.value:
+            assert op1 == 0, "Per-dimension block IDs are not supported in persistent mode."
+            out.append(encode(EU.IU, IUSubtype.ADDI, dst, BLOCK_REG, 0))
+        elif eu == EU.BRU and subtype == BRUSubtype.STOP.value:
+            out.append(encode(EU.BRU, BRUSubtype.JMP, 0, RETURN_REG, 0))
+        else:
+            if eu == EU.BRU and subtype in (BRUSubtype.BRZ.value, BRUSubtype.BRNZ.value):
+                branches.append((i, len(out)))
+            out.append(word)
+    index_map.append(len(out))
+
+    for i, new_index in branches:
+        offset = words[i] & 0xFF
+        if offset & 0x80:
+            offset -= 0x100
+        new_offset = index_map[i + 1 + offset] - (new_index + 1)
+        assert -128 <= new_offset <= 127, f"Branch at instruction {i} is out of range after the persistent rewrite."
+        out[new_index] = (out[new_index] & ~0xFF) | (new_offset & 0xFF)
+
+    return b''.join(word.to_bytes(4, byteorder='little') for word in out)
@@ -0,0 +1,140 @@
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from bgpu_driver import BGPUDriver, as_bytes
+
+logger = logging.getLogger("bgpu.multi")
+
+class MultiBuffer:
+    # One allocation of the same size on every device. After a launch the
+    # output buffers are split: each device only holds the slices written by
+    # its own TBlocks, recorded in partition as (device, start, end) byte ranges.
+    def __init__(self, size: int, bufs: list):
+        self.size = size
+        self.bufs = bufs
+        self.partition = None
+
+    def __getitem__(self, device: int):
+        return self.bufs[device]
+
+class BGPUMultiDriver:
+    # Shards the TBlocks of a launch over several boards, each driven by its
+    # own BGPUDriver. Inputs are replicated to every device, outputs are
+    # gathered per block slice, so kernels must write their output buffers in
+    # contiguous equally sized slices per TBlock (the usual data-parallel case).
+    def __init__(self, devices: list[dict]):
+        assert len(devices) > 0, "Need at least one device."
+        self.devices = [BGPUDriver(**device_args) for device_args in devices]
+        self.pool = ThreadPoolExecutor(max_workers=len(self.devices))
+        self.last_split = None
+        # Moving average of the launch time per TBlock, per kernel and device
+        self.block_times = {}
+        self.smoothing = 0.5
+        logger.info("Multi-device BGPU driver initialized with %d devices.", len(self.devices))
+
+    @classmethod
+    def emulated(cls, num_devices: int, **driver_args):
+        return cls([dict(emu=True, **driver_args) for _ in range(num_devices)])
+
+    def on_all(self, fn) -> list:
+        # Runs fn(device_index, driver) on every device concurrently
+        futures = [self.pool.submit(fn, i, device) for i, device in enumerate(self.devices)]
+        return [future.result() for future in futures]
+
+    def alloc(self, size: int) -> MultiBuffer:
+        return MultiBuffer(size, self.on_all(lambda i, device: device.alloc(size)))
+
+    def free(self, buf: MultiBuffer):
+        self.on_all(lambda i, device: device.free(buf[i]))
+
+    def copy_h2d(self, dest: MultiBuffer, src: memoryview):
+        data = bytes(src)
+        self.on_all(lambda i, device: device.copy_h2d(dest[i], memoryview(data)))
+        dest.partition = None
+
+    def copy_d2h(self, dest: memoryview, src: MultiBuffer):
+        if src.partition is None:
+            self.devices[0].copy_d2h(dest, src[0])
+            return
+
+        dest = as_bytes(dest)
+        # Every device returns the slices its TBlocks produced
+        def gather(i, device):
+            for owner, start, end in src.partition:
+                if owner != i or start >= len(dest):
+                    continue
+                end = min(end, len(dest))
+                addr, _ = src[i]
+                device.copy_d2h(dest[start:end], (addr + start, end - start))
+        self.on_all(gather)
+
+    def make_coherent(self, buf: MultiBuffer):
+        # A partitioned buffer used as a kernel argument again must hold the
+        # complete data on every device
+        data = bytearray(buf.size)
+        self.copy_d2h(memoryview(data), buf)
+        self.copy_h2d(buf, memoryview(data))
+
+    def record_block_time(self, key: bytes, device: int, metrics: dict):
+        # Whole launch latency including dispatch, that is what the split has to balance
+        block_time = metrics['latency'] / metrics['tblocks']
+        old = self.block_times.get((key, device))
+        self.block_times[(key, device)] = block_time if old is None else old + self.smoothing * (block_time - old)
+
+    def split_blocks(self, num_blocks: int, key: bytes) -> list[tuple[int, int]]:
+        # Shares are proportional to each device's measured blocks per second.
+        # Until every device ran the kernel once, blocks are split evenly.
+        times = [self.block_times.get((key, i)) for i in range(len(self.devices))]
+        if any(t is None or t <= 0 for t in times):
+            weights = [1.0] * len(self.devices)
+        else:
+            weights = [1.0 / t for t in times]
+
+        total = sum(weights)
+        exact = [num_blocks * w / total for w in weights]
+        counts = [int(e) for e in exact]
+        # Hand the leftover blocks to the largest remainders
+        for i in sorted(range(len(counts)), key=lambda i: counts[i] - exact[i])[:num_blocks - sum(counts)]:
+            counts[i] += 1
+
+        ranges = []
+        start = 0
+        for count in counts:
+            ranges.append((start, start + count))
+            start += count
+        return ranges
+
+    def run_kernel(self, *args, global_size:tuple[int,int,int], local_size:tuple[int,int,int], program, function_name:str, outputs=(0,), timeout=None):
+        # outputs are the indices of the buffers in args[0] written by the kernel
+        arg_bufs = args[0]
+        for buf in arg_bufs:
+            if isinstance(buf, MultiBuffer) and buf.partition is not None:
+                self.make_coherent(buf)
+
+        num_blocks = global_size[0] * global_size[1] * global_size[2]
+        key = hashlib.sha256(bytes(program)).digest()
+        ranges = self.split_blocks(num_blocks, key)
+        self.last_split = ranges
+        logger.debug("Splitting %d TBlocks of %s over devices: %s", num_blocks, function_name, ranges)
+
+        def launch(i, device):
+            first_block, end_block = ranges[i]
+            if first_block == end_block:
+                return None
+            # Scalar arguments are the same on every device
+            device_args = [buf[i] if isinstance(buf, MultiBuffer) else buf for buf in arg_bufs]
+            device.run_kernel(device_args, global_size=global_size, local_size=local_size, program=program, function_name=function_name, timeout=timeout, block_range=(first_block, end_block))
+            self.record_block_time(key, i, device.last_launch)
+            return device.last_launch
+        metrics = self.on_all(launch)
+
+        for index in outputs:
+            buf = arg_bufs[index]
+            assert buf.size % num_blocks == 0, f"Output buffer of {buf.size} bytes cannot be split into {num_blocks} TBlocks."
+            block_bytes = buf.size // num_blocks
+            buf.partition = [(i, first_block * block_bytes, end_block * block_bytes) for i, (first_block, end_block) in enumerate(ranges) if first_block != end_block]
+        return metrics
+
+    def close(self):
+        self.pool.shutdown()
@@ -0,0 +1,71 @@
+import hashlib
+
+import numpy as np
+import pytest
+
+from bgpu_assembler import BGPUAssembler, example_asm
+from bgpu_multi import BGPUMultiDriver
+
+program = bytes(BGPUAssembler().assemble_lines(example_asm.splitlines()))
+
+@pytest.fixture
+def multi():
+    multi = BGPUMultiDriver.emulated(2, trace=False)
+    yield multi
+    multi.close()
+
+def upload(multi, values):
+    buf = multi.alloc(values.nbytes)
+    multi.copy_h2d(buf, memoryview(values))
+    return buf
+
+def download(multi, buf):
+    out = np.zeros(buf.size // 4, np.int32)
+    multi.copy_d2h(memoryview(out), buf)
+    return out
+
+def add(multi, a, b, c):
+    # E_16_4_4: a = b + c, every TBlock writes 16 consecutive words
+    multi.run_kernel([a, b, c], global_size=(4, 1, 1), local_size=(4, 1, 1), program=program, function_name="E_16_4_4")
+
+def test_outputs_are_gathered(multi):
+    b = np.arange(64, dtype=np.int32)
+    c = np.arange(64, dtype=np.int32) * 10
+    a_buf = upload(multi, np.zeros(64, np.int32))
+    add(multi, a_buf, upload(multi, b), upload(multi, c))
+    assert multi.last_split == [(0, 2), (2, 4)]
+    assert a_buf.partition is not None
+    assert (download(multi, a_buf) == b + c).all()
+
+def test_partitioned_output_reused_as_input(multi):
+    b = np.arange(64, dtype=np.int32)
+    a_buf = upload(multi, np.zeros(64, np.int32))
+    b_buf = upload(multi, b)
+    d_buf = upload(multi, np.zeros(64, np.int32))
+    add(multi, a_buf, b_buf, b_buf)
+    # a is split over both devices, the launch makes it whole on each first
+    add(multi, d_buf, a_buf, b_buf)
+    assert a_buf.partition is None
+    assert (download(multi, d_buf) == 3 * b).all()
+    for i, device in enumerate(multi.devices):
+        out = np.zeros(64, np.int32)
+        device.copy_d2h(memoryview(out), a_buf[i])
+        assert (out == 2 * b).all()
+
+def test_uneven_split(multi):
+    key = hashlib.sha256(program).digest()
+    # Device 0 ran the kernel three times faster per TBlock
+    multi.block_times[(key, 0)] = 1.0
+    multi.block_times[(key, 1)] = 3.0
+    assert multi.split_blocks(4, key) == [(0, 3), (3, 4)]
+    assert multi.split_blocks(8, key) == [(0, 6), (6, 8)]
+
+    b = np.arange(64, dtype=np.int32)
+    a_buf = upload(multi, np.zeros(64, np.int32))
+    b_buf = upload(multi, b)
+    multi.block_times[(key, 0)] = 1.0
+    multi.block_times[(key, 1)] = 3.0
+    add(multi, a_buf, b_buf, b_buf)
+    assert multi.last_split == [(0, 3), (3, 4)]
+    assert a_buf.partition == [(0, 0, 192), (1, 192, 256)]
+    assert (download(multi, a_buf) == 2 * b).all()
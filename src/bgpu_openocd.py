@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+import re
+import socket
+import socketserver
+import threading
+
+TCL_TERMINATOR = b'\x1a'
+
+class OpenOcdError(Exception):
+    pass
+
+class OpenOcdJtag:
+    # Talks to OpenOCD's TCL RPC port directly, no gdb in between
+    def __init__(self, host='localhost', port=6666, max_block=4096):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.max_block = max_block
+        self.rx = bytearray()
+        # TCL round trips so far, a script of several commands is one
+        self.transactions = 0
+
+    def command(self, command: str) -> str:
+        self.transactions += 1
+        self.sock.sendall(command.encode() + TCL_TERMINATOR)
+        while TCL_TERMINATOR not in self.rx:
+            chunk = self.sock.recv(65536)
+            if len(chunk) == 0:
+                raise OpenOcdError("OpenOCD closed the TCL connection")
+            self.rx.extend(chunk)
+        end = self.rx.index(TCL_TERMINATOR)
+        resp = self.rx[:end].decode()
+        del self.rx[:end + 1]
+        return resp.strip()
+
+    def parse_values(self, resp: str, count: int) -> list[int]:
+        try:
+            values = [int(v, 0) for v in resp.split()]
+        except ValueError:
+            raise OpenOcdError(f"Memory read failed: {resp}")
+        if len(values) != count:
+            raise OpenOcdError(f"Memory read returned {len(values)} values, expected {count}: {resp}")
+        return values
+
+    def expect_empty(self, resp: str):
+        if resp != '':
+            raise OpenOcdError(f"Memory write failed: {resp}")
+
+    def write_memory_command(self, address, data: bytes) -> str:
+        if address % 4 == 0 and len(data) % 4 == 0:
+            width = 32
+            values = [int.from_bytes(data[i:i+4], byteorder='little') for i in range(0, len(data), 4)]
+        else:
+            width = 8
+            values = list(data)
+        return f"write_memory {address:#010x} {width} {{{' '.join(f'{v:#x}' for v in values)}}}"
+
+    def write(self, address, data, check=True):
+        self.expect_empty(self.command(f"write_memory {address:#010x} 32 {{{data:#010x}}}"))
+
+        if check:
+            read_value = self.read(address)
+            if read_value != data:
+                raise ValueError(f"Data mismatch at address {address:#010x}: expected {data:#010x}, got {read_value:#010x}")
+
+    def read(self, address):
+        return self.parse_values(self.command(f"read_memory {address:#010x} 32 1"), 1)[0]
+
+    def write_block(self, address, data: bytes, check=True):
+        data = bytes(data)
+        for offset in range(0, len(data), self.max_block):
+            self.expect_empty(self.command(self.write_memory_command(address + offset, data[offset:offset + self.max_block])))
+
+        if check:
+            read_back = self.read_block(address, len(data))
+            if read_back != data:
+                raise ValueError(f"Data mismatch in block at address {address:#010x} of size {len(data)} bytes")
+
+    def read_block(self, address, size) -> bytes:
+        data = bytearray()
+        for offset in range(0, size, self.max_block):
+            chunk = min(self.max_block, size - offset)
+            if (address + offset) % 4 == 0 and chunk % 4 == 0:
+                for value in self.parse_values(self.command(f"read_memory {address + offset:#010x} 32 {chunk // 4}"), chunk // 4):
+                    data.extend(value.to_bytes(4, byteorder='little'))
+            else:
+                data.extend(self.parse_values(self.command(f"read_memory {address + offset:#010x} 8 {chunk}"), chunk))
+        return bytes(data)
+
+    def write_many(self, writes: list[tuple[int, int]], check=True):
+        # All writes go out as a single TCL script -> one round trip
+        if len(writes) == 0:
+            return
+        self.expect_empty(self.command('; '.join(f"write_memory {address:#010x} 32 {{{data:#010x}}}" for address, data in writes)))
+
+        if check:
+            read_values = self.read_many([address for address, _ in writes])
+            for (address, data), read_value in zip(writes, read_values):
+                if read_value != data:
+                    raise ValueError(f"Data mismatch at address {address:#010x}: expected {data:#010x}, got {read_value:#010x}")
+
+    def read_many(self, addresses: list[int]) -> list[int]:
+        if len(addresses) == 0:
+            return []
+        resp = self.command('concat ' + ' '.join(f"[read_memory {address:#010x} 32 1]" for address in addresses))
+        return self.parse_values(resp, len(addresses))
+
+    def close(self):
+        self.sock.close()
+
+class OpenOcdStandInHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        rx = bytearray()
+        while True:
+            chunk = self.request.recv(65536)
+            if len(chunk) == 0:
+                return
+            rx.extend(chunk)
+            while TCL_TERMINATOR in rx:
+                end = rx.index(TCL_TERMINATOR)
+                command = rx[:end].decode()
+                del rx[:end + 1]
+                self.request.sendall(self.server.execute(command).encode() + TCL_TERMINATOR)
+
+class OpenOcdStandIn(socketserver.ThreadingTCPServer):
+    # Local stand-in for OpenOCD's TCL RPC server, backed by a target such as
+    # EmuJtag. Understands the subset of commands OpenOcdJtag sends.
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, target, host='127.0.0.1', port=0):
+        super().__init__((host, port), OpenOcdStandInHandler)
+        self.target = target
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def read_memory(self, address, width, count) -> str:
+        if width == 32:
+            return ' '.join(f"{self.target.read(address + i * 4):#x}" for i in range(count))
+        assert width == 8, f"Unsupported access width: {width}"
+        return ' '.join(f"{b:#x}" for b in self.target.read_block(address, count))
+
+    def write_memory(self, address, width, values: list[int]):
+        if width == 32:
+            for i, value in enumerate(values):
+                self.target.write(address + i * 4, value, check=False)
+            return
+        assert width == 8, f"Unsupported access width: {width}"
+        self.target.write_block(address, bytes(values), check=False)
+
+    def execute_one(self, command: str) -> str:
+        parts = command.replace('{', ' ').replace('}', ' ').split()
+        if len(parts) == 0:
+            return ''
+        if parts[0] == 'read_memory':
+            return self.read_memory(int(parts[1], 0), int(parts[2]), int(parts[3]))
+        if parts[0] == 'write_memory':
+            self.write_memory(int(parts[1], 0), int(parts[2]), [int(v, 0) for v in parts[3:]])
+            return ''
+        return f"invalid command name \"{parts[0]}\""
+
+    def execute(self, command: str) -> str:
+        with self.lock:
+            try:
+                if command.startswith('concat '):
+                    return ' '.join(self.execute_one(sub) for sub in re.findall(r'\[([^\]]*)\]', command))
+                resp = ''
+                for sub in command.split(';'):
+                    resp = self.execute_one(sub)
+                    # Like Tcl, stop the script at the first failing command
+                    if resp.startswith('invalid'):
+                        break
+                return resp
+            except (ValueError, AssertionError, RuntimeError) as e:
+                return str(e)
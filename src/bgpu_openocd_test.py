@@ -0,0 +1,56 @@
+import pytest
+
+from bgpu_emu import EmuJtag
+from bgpu_openocd import OpenOcdError, OpenOcdJtag, OpenOcdStandIn
+
+@pytest.fixture
+def con():
+    server = OpenOcdStandIn(EmuJtag(memory_size=1 << 16, trace=False)).start()
+    con = OpenOcdJtag(port=server.port, max_block=64)
+    yield con
+    con.close()
+    server.stop()
+
+def test_word_write_read(con):
+    con.write(0x100, 0xdeadbeef)
+    assert con.read(0x100) == 0xdeadbeef
+    assert con.read_block(0x100, 4) == (0xdeadbeef).to_bytes(4, byteorder='little')
+
+def test_block_write_read(con):
+    # Larger than max_block, so split into several commands
+    data = bytes(i & 0xff for i in range(200))
+    con.write_block(0x200, data)
+    assert con.read_block(0x200, len(data)) == data
+
+def test_unaligned_block_write_read(con):
+    data = bytes(range(1, 8))
+    con.write_block(0x301, data)
+    assert con.read_block(0x301, len(data)) == data
+    assert con.read_block(0x300, 9) == b'\x00' + data + b'\x00'
+
+def test_write_many_read_many(con):
+    writes = [(0x400 + i * 8, i * 0x01010101) for i in range(16)]
+    con.write_many(writes)
+    assert con.read_many([address for address, _ in writes]) == [data for _, data in writes]
+    assert con.read_many([]) == []
+
+def test_read_error(con):
+    with pytest.raises(OpenOcdError):
+        con.read(0x20000)
+    # The connection stays usable after an error response
+    con.write(0, 1)
+    assert con.read(0) == 1
+
+def test_write_error(con):
+    with pytest.raises(OpenOcdError):
+        con.write(0x20000, 1, check=False)
+    with pytest.raises(OpenOcdError):
+        con.write_block(0x20000, bytes(8), check=False)
+
+def test_write_many_error(con):
+    with pytest.raises(OpenOcdError):
+        con.write_many([(0, 1), (0x20000, 2)], check=False)
+
+def test_unknown_command(con):
+    with pytest.raises(OpenOcdError):
+        con.parse_values(con.command("mdw 0 1"), 1)
@@ -0,0 +1,178 @@
+import logging
+import struct
+import time
+
+from bgpu_kernels import BLOCK_SIZE, PERSISTENT_DESCRIPTOR_WORDS, PERSISTENT_MAX_PARAMS, PERSISTENT_SLOT_BYTES, builtin_label, builtin_program, make_persistent
+
+logger = logging.getLogger("bgpu.persistent")
+
+class PersistentQueue:
+    # Keeps one scheduler kernel resident on the device. It polls a mailbox in
+    # device memory for launch descriptors (layout in bgpu_kernels), so a
+    # launch costs one descriptor write and one head write instead of a
+    # thread engine dispatch and its status polling. While the queue runs the
+    # thread engine is busy: copies go over the link uncompressed, other
+    # launches, fills and device copies are refused. Wait for a launch before
+    # reading the buffers it writes. Only backends that run dispatches in the
+    # background (supports_persistent) can host the scheduler.
+    def __init__(self, driver, slots=16):
+        assert slots > 0 and slots & (slots - 1) == 0, "Slot count must be a power of two."
+        assert getattr(driver.con, 'supports_persistent', False), f"The {driver.backend} backend cannot run a persistent scheduler, it needs dispatches running in the background (emulator with threaded=True)."
+        self.driver = driver
+        self.slots = slots
+        self.ring_offset = (2 + BLOCK_SIZE) * 4
+        self.seq = 0
+        self.completed_seq = 0
+        self.launches = 0
+        # Rewritten kernel images, keyed like the driver's kernel cache
+        self.images = {}
+
+        with driver.lock:
+            self.mailbox = driver.alloc(self.ring_offset + slots * PERSISTENT_SLOT_BYTES)
+            driver.fill(self.mailbox, 0)
+            # The device writes the mailbox, the host shadow would go stale
+            driver.invalidate(self.mailbox)
+
+            program = builtin_program("scheduler", 4)
+            params = struct.pack('<3I', 0, 0, slots - 1)
+            self.scheduler = driver.alloc(len(program) + len(params))
+            scheduler_addr = self.scheduler[0]
+            params = struct.pack('<3I', self.mailbox[0], scheduler_addr + builtin_label("scheduler", 4, "block_next"), slots - 1)
+            driver.copy_h2d(self.scheduler, memoryview(program + params))
+
+            driver.bgpu.set_launch_geometry((1, 1, 1), (BLOCK_SIZE, 1, 1))
+            driver.bgpu.dispatch_threads(scheduler_addr, scheduler_addr + len(program), BLOCK_SIZE, 1, 0, inorder=True)
+            driver.persistent_queue = self
+        self.running = True
+        logger.info("Persistent scheduler started with %d descriptor slots, mailbox at %#010x.", slots, self.mailbox[0])
+
+    def image_for(self, program) -> int:
+        key = self.driver.kernel_key(program)
+        image = self.images.get(key)
+        if image is None:
+            code = make_persistent(bytes(program))
+            with self.driver.lock:
+                image = self.driver.alloc(len(code))
+                self.driver.copy_h2d(image, memoryview(code))
+            self.images[key] = image
+        return image[0]
+
+    def completed(self) -> int:
+        # Every scheduler thread reports the last descriptor it finished
+        with self.driver.lock:
+            data = self.driver.con.read_block(self.mailbox[0] + 8, BLOCK_SIZE * 4)
+        self.completed_seq = min(struct.unpack(f'<{BLOCK_SIZE}I', data))
+        return self.completed_seq
+
+    def post(self, descriptor: list, params: bytes) -> int:
+        assert self.running, "Persistent scheduler is not running."
+        seq = self.seq + 1
+        # The slot is free once its previous descriptor finished
+        if seq - self.slots > self.completed_seq:
+            self.wait(seq - self.slots)
+        slot = self.mailbox[0] + self.ring_offset + (seq & (self.slots - 1)) * PERSISTENT_SLOT_BYTES
+        descriptor = [descriptor[0], slot + PERSISTENT_DESCRIPTOR_WORDS * 4] + descriptor[1:]
+        descriptor += [0] * (PERSISTENT_DESCRIPTOR_WORDS - len(descriptor))
+        with self.driver.lock:
+            # The descriptor must land before the head moves, the link keeps the order
+            self.driver.con.write_block(slot, struct.pack(f'<{PERSISTENT_DESCRIPTOR_WORDS}I', *descriptor) + params, check=False)
+            self.driver.con.write(self.mailbox[0], seq, check=False)
+        self.seq = seq
+        return seq
+
+    def launch(self, *args, global_size:tuple[int,int,int], local_size:tuple[int,int,int], program, function_name:str, access: list = None) -> int:
+        # Returns the sequence number of the launch, pass it to wait()
+        arg_bufs = args[0]
+        assert len(global_size) == 3 and len(local_size) == 3, "Global and local sizes must be 3-tuples."
+        assert len(arg_bufs) <= PERSISTENT_MAX_PARAMS, f"Persistent launches take at most {PERSISTENT_MAX_PARAMS} arguments."
+        tblock_size = local_size[0] * local_size[1] * local_size[2]
+        num_blocks = global_size[0] * global_size[1] * global_size[2]
+        assert 0 < tblock_size <= BLOCK_SIZE, f"TBlock size {tblock_size} exceeds the {BLOCK_SIZE} scheduler threads."
+        assert num_blocks > 0, "Kernel launch needs at least one TBlock."
+
+        driver = self.driver
+        with driver.lock:
+            pc = self.image_for(program)
+            params = driver.pack_params(arg_bufs)
+            for buf in driver.written_args(arg_bufs, access):
+                driver.invalidate(buf)
+            seq = self.post([pc, 0, num_blocks, tblock_size], params)
+        self.launches += 1
+        logger.debug("Posted persistent launch %d of %s: %d TBlocks of %d threads.", seq, function_name, num_blocks, tblock_size)
+        return seq
+
+    def scheduler_finished(self) -> bool:
+        with self.driver.lock:
+            return self.driver.bgpu.dispatch_status()[2]
+
+    def wait(self, seq=None, timeout=None, poll_min=1e-5, poll_max=0.01, backoff=2.0) -> int:
+        # Waits until launch seq (default: the newest) finished
+        seq = self.seq if seq is None else seq
+
+        def done():
+            if self.completed() >= seq:
+                return True
+            # A scheduler that stopped early will never get there
+            if self.scheduler_finished():
+                raise RuntimeError(f"Persistent scheduler stopped before launch {seq} finished.")
+            return False
+
+        self.driver.bgpu.wait_for_completion(timeout=timeout, poll_min=poll_min, poll_max=poll_max, backoff=backoff, until=done)
+        return self.completed_seq
+
+    def synchronize(self, timeout=None):
+        self.wait(timeout=timeout)
+
+    def stop(self, timeout=None):
+        # An entry PC of 0 makes every scheduler thread stop
+        if not self.running:
+            return
+        self.post([0, 0, 0, 0], b'')
+        self.running = False
+        self.driver.bgpu.wait_for_completion(timeout=timeout, until=self.scheduler_finished)
+        with self.driver.lock:
+            self.driver.persistent_queue = None
+            for image in self.images.values():
+                self.driver.free(image)
+            self.driver.free(self.scheduler)
+            self.driver.free(self.mailbox)
+        self.images = {}
+        logger.info("Persistent scheduler stopped after %d launches.", self.launches)
+
+if __name__ == "__main__":
+    # Many small launches, one thread engine dispatch each vs. one persistent scheduler
+    import numpy as np
+
+    from bgpu_assembler import BGPUAssembler, example_asm
+    from bgpu_driver import BGPUDriver
+
+    launches = 50
+    program = bytes(BGPUAssembler().assemble_lines(example_asm.splitlines()))
+    driver = BGPUDriver(emu=True, threaded=True, trace=False)
+    a = driver.from_numpy(np.zeros(64, np.int32))
+    b = driver.from_numpy(np.arange(64, dtype=np.int32))
+    c = driver.from_numpy(np.arange(64, dtype=np.int32) * 2)
+    args = [a, b, c]
+    profiler = driver.enable_profiling()
+
+    start = time.perf_counter()
+    for _ in range(launches):
+        driver.run_kernel(args, global_size=(4, 1, 1), local_size=(4, 1, 1), program=program, function_name="E_16_4_4")
+    dispatch_time = time.perf_counter() - start
+    dispatch_transactions = sum(totals['transactions'] for totals in profiler.summary()['transfers'].values())
+    expected = driver.to_numpy(a).copy()
+
+    driver.fill(a, 0)
+    queue = driver.persistent()
+    profiler.clear()
+    start = time.perf_counter()
+    for _ in range(launches):
+        queue.launch(args, global_size=(4, 1, 1), local_size=(4, 1, 1), program=program, function_name="E_16_4_4")
+    queue.synchronize()
+    persistent_time = time.perf_counter() - start
+    persistent_transactions = sum(totals['transactions'] for totals in profiler.summary()['transfers'].values())
+    queue.stop()
+    assert (driver.to_numpy(a) == expected).all(), "Persistent launches produced different results."
+
+    print(f"{launches} launches with dispatches:       {dispatch_time * 1e3:8.2f} ms, {dispatch_transactions} link transactions")
+    print(f"{launches} launches on persistent kernel:  {persistent_time * 1e3:8.2f} ms, {persistent_transactions} link transactions")
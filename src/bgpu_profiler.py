@@ -0,0 +1,137 @@
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+class NullProfiler:
+    # Stands in while profiling is off, spans cost a single call
+    enabled = False
+
+    def span(self, name: str, cat: str, **args):
+        return nullcontext()
+
+    def transfer(self, name: str, start: float, end: float, nbytes: int, transactions: int):
+        pass
+
+NULL_PROFILER = NullProfiler()
+
+class BgpuProfiler:
+    # Collects timed spans and link transfers. Spans nest per thread and are
+    # exported as Chrome trace events (chrome://tracing, Perfetto).
+    enabled = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.events = []
+        self.transfers = {}
+
+    def clear(self):
+        with self.lock:
+            self.origin = time.perf_counter()
+            self.events = []
+            self.transfers = {}
+
+    def add_event(self, name: str, cat: str, start: float, end: float, args: dict):
+        with self.lock:
+            self.events.append((name, cat, start, end, threading.get_ident(), args))
+
+    @contextmanager
+    def span(self, name: str, cat: str, **args):
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.add_event(name, cat, start, time.perf_counter(), args)
+
+    def transfer(self, name: str, start: float, end: float, nbytes: int, transactions: int):
+        # One connection call, possibly several transactions on the link
+        self.add_event(name, "link", start, end, {'bytes': nbytes, 'transactions': transactions})
+        with self.lock:
+            totals = self.transfers.setdefault(name, {'calls': 0, 'bytes': 0, 'transactions': 0, 'time': 0.0})
+            totals['calls'] += 1
+            totals['bytes'] += nbytes
+            totals['transactions'] += transactions
+            totals['time'] += end - start
+
+    def chrome_trace(self) -> dict:
+        with self.lock:
+            events = list(self.events)
+        trace = []
+        for name, cat, start, end, tid, args in events:
+            trace.append({
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': (start - self.origin) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': 0,
+                'tid': tid,
+                'args': args,
+            })
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def summary(self) -> dict:
+        with self.lock:
+            events = list(self.events)
+            transfers = {name: dict(totals) for name, totals in self.transfers.items()}
+
+        phases = {}
+        for name, cat, start, end, tid, args in events:
+            if cat == "link":
+                continue
+            phase = phases.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+            phase['count'] += 1
+            phase['total'] += end - start
+            phase['max'] = max(phase['max'], end - start)
+        for phase in phases.values():
+            phase['mean'] = phase['total'] / phase['count']
+
+        for totals in transfers.values():
+            totals['bandwidth'] = totals['bytes'] / totals['time'] if totals['time'] > 0 else 0.0
+        return {'phases': phases, 'transfers': transfers}
+
+class ProfiledConnection:
+    # Wraps any connection backend (EmuJtag, GdbJtag, OpenOcdJtag) and
+    # reports every call with its payload size to the profiler. Backends
+    # count the commands they send in their transactions attribute, the
+    # given count is only the estimate for backends that do not.
+    def __init__(self, con, profiler: BgpuProfiler):
+        self.con = con
+        self.profiler = profiler
+
+    def timed(self, name: str, nbytes: int, transactions: int, fn, *args, **kwargs):
+        counted = getattr(self.con, 'transactions', None)
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            end = time.perf_counter()
+            if counted is not None:
+                transactions = self.con.transactions - counted
+            self.profiler.transfer(name, start, end, nbytes, transactions)
+
+    def write(self, address, data, check=True):
+        return self.timed("write", 4, 2 if check else 1, self.con.write, address, data, check)
+
+    def read(self, address):
+        return self.timed("read", 4, 1, self.con.read, address)
+
+    def write_block(self, address, data: bytes, check=True):
+        return self.timed("write_block", len(data), 2 if check else 1, self.con.write_block, address, data, check)
+
+    def read_block(self, address, size) -> bytes:
+        return self.timed("read_block", size, 1, self.con.read_block, address, size)
+
+    def write_many(self, writes: list[tuple[int, int]], check=True):
+        return self.timed("write_many", 4 * len(writes), 2 if check else 1, self.con.write_many, writes, check)
+
+    def read_many(self, addresses: list[int]) -> list[int]:
+        return self.timed("read_many", 4 * len(addresses), 1, self.con.read_many, addresses)
+
+    def __getattr__(self, name):
+        return getattr(self.con, name)
@@ -0,0 +1,58 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# Time from interpreter start to a ready driver, measured in fresh processes
+# like the short-lived CI jobs that create them
+probe = """
+import sys, time
+start = time.perf_counter()
+import bgpu_driver
+imported = time.perf_counter()
+driver = bgpu_driver.BGPUDriver(backend={backend!r}, memory_size={memory_size}, **{backend_args!r})
+ready = time.perf_counter()
+print(imported - start, ready - imported, ' '.join(sorted(m for m in ('numpy', 'bgpu_emu', 'bgpu_jtag', 'bgpu_openocd', 'pygdbmi') if m in sys.modules)))
+"""
+
+def measure(backend: str, memory_size: int, runs: int, **backend_args) -> dict:
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    imports, inits, totals = [], [], []
+    modules = ""
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", probe.format(backend=backend, memory_size=memory_size, backend_args=backend_args)], cwd=src_dir, capture_output=True, text=True, check=True).stdout.split(maxsplit=2)
+        imports.append(float(out[0]))
+        inits.append(float(out[1]))
+        totals.append(float(out[0]) + float(out[1]))
+        modules = out[2].strip() if len(out) > 2 else ""
+    return {
+        'import': statistics.median(imports),
+        'init': statistics.median(inits),
+        'total': statistics.median(totals),
+        'modules': modules.split(),
+    }
+
+def report(name: str, result: dict):
+    print(f"{name}: import {result['import'] * 1e3:7.2f} ms, init {result['init'] * 1e3:7.2f} ms, total {result['total'] * 1e3:7.2f} ms (loaded: {' '.join(result['modules'])})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure BGPU driver startup time.")
+    parser.add_argument("--runs", type=int, default=10, help="Number of fresh processes per configuration")
+    parser.add_argument("--memory-size", type=lambda s: int(s, 0), action="append", help="Emulated memory sizes to test (default: 64 KiB and 16 MiB)")
+    args = parser.parse_args()
+
+    for memory_size in args.memory_size or [1 << 16, 1 << 24]:
+        report(f"emu, {memory_size:>9} bytes", measure("emu", memory_size, args.runs))
+
+    # A hardware backend, talking to a local OpenOCD stand-in
+    from bgpu_emu import EmuJtag
+    from bgpu_openocd import OpenOcdStandIn
+    server = OpenOcdStandIn(EmuJtag(trace=False)).start()
+    try:
+        result = measure("openocd", 1 << 16, args.runs, port=server.port)
+    finally:
+        server.stop()
+    report("openocd, stand-in     ", result)
+    # Hardware drivers must not pay for NumPy or the emulator
+    assert 'numpy' not in result['modules'] and 'bgpu_emu' not in result['modules'], f"openocd driver loaded {result['modules']}"
@@ -0,0 +1,84 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+class BgpuEvent:
+    def __init__(self, name: str):
+        self.name = name
+        self.future = Future()
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def wait(self, timeout=None):
+        return self.future.result(timeout)
+
+    def __repr__(self):
+        state = 'done' if self.done() else 'pending'
+        return f"BgpuEvent({self.name}, {state})"
+
+class BgpuStream:
+    # Commands run in order on a background worker thread. Each command
+    # returns an event; wait_for adds dependencies on events of other streams.
+    def __init__(self, driver):
+        self.driver = driver
+        self.commands = queue.Queue()
+        self.last_event = None
+        self.error = None
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def enqueue(self, name: str, fn, wait_for=()) -> BgpuEvent:
+        event = BgpuEvent(name)
+        self.commands.put((event, fn, list(wait_for)))
+        self.last_event = event
+        return event
+
+    def run(self):
+        while True:
+            command = self.commands.get()
+            if command is None:
+                return
+            event, fn, wait_for = command
+
+            # A failed command fails everything queued after it on this stream
+            if self.error is not None:
+                event.future.set_exception(RuntimeError(f"Stream failed before {event.name}: {self.error}"))
+                continue
+
+            try:
+                for dep in wait_for:
+                    dep.wait()
+                result = fn()
+            except Exception as e:
+                self.error = e
+                event.future.set_exception(e)
+                continue
+            event.future.set_result(result)
+
+    def copy_h2d(self, dest, src: memoryview, wait_for=()) -> BgpuEvent:
+        # Snapshot the source so the caller can reuse its buffer right away
+        data = bytes(src)
+        return self.enqueue("copy_h2d", lambda: self.driver.copy_h2d(dest, memoryview(data)), wait_for)
+
+    def copy_d2h(self, dest: memoryview, src, wait_for=()) -> BgpuEvent:
+        def copy():
+            self.driver.copy_d2h(dest, src)
+            return dest
+        return self.enqueue("copy_d2h", copy, wait_for)
+
+    def launch(self, *args, global_size:tuple[int,int,int], local_size:tuple[int,int,int], program, function_name:str, timeout=None, wait_for=(), access: list = None) -> BgpuEvent:
+        program = bytes(program)
+        return self.enqueue(f"launch {function_name}", lambda: self.driver.run_kernel(*args, global_size=global_size, local_size=local_size, program=program, function_name=function_name, timeout=timeout, access=access), wait_for)
+
+    def record(self, wait_for=()) -> BgpuEvent:
+        # Marker that completes once all previously queued commands completed
+        return self.enqueue("record", lambda: None, wait_for)
+
+    def synchronize(self):
+        if self.last_event is not None:
+            self.last_event.wait()
+
+    def close(self):
+        self.commands.put(None)
+        self.worker.join()
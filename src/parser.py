@@ -1,6 +1,10 @@
 # Copyright 2025 Tobias Senti
+import logging
+
 from util import ParsedInstruction, Modifier, Operand
 
+logger = logging.getLogger("bgpu.parser")
+
 class Parser():
     def parse_file(self, filepath: str) -> list[ParsedInstruction]:
         with open(filepath, 'r') as file:
@@ -10,9 +14,11 @@ class Parser():
     def parse_lines(self, lines: list[str]) -> list[ParsedInstruction]:
         last_label = None
         instructions = []
+        debug = logger.isEnabledFor(logging.DEBUG)
         for line in lines:
             line = line.strip()
-            print(f"Parsing line: {line}")
+            if debug:
+                logger.debug("Parsing line: %s", line)
             line = line.split('#')[0].strip() # Remove comments
             
             # Skip empty lines
@@ -23,7 +29,8 @@ class Parser():
 
             # We have a lable in this line
             if len(parts) == 1 and parts[0].endswith(':'):
-                print(f"Found label: {parts[0]}")
+                if debug:
+                    logger.debug("Found label: %s", parts[0])
                 last_label = parts[0][:-1]
                 continue
 
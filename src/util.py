@@ -107,6 +107,10 @@ class ParsedInstruction:
             string = f"// {self.label}:\n" + string
         return string
 
+    def signature(self) -> tuple:
+        # Everything instruction validation looks at
+        return (self.instruction, tuple(mod.type for mod in self.modifiers), tuple(op.type for op in self.operands))
+
     def has_modifier(self, mod_type: ModifierType) -> bool:
         for mod in self.modifiers:
             if mod.type == mod_type: